@@ -1,17 +1,23 @@
 from collections import deque
+import time
+
+# Seconds the simulated committer takes to handle one event.
+DELAY = 0.005
 
 class CommitterEventHandler(object):
+    eventTypes = frozenset(("JOB_SETUP", "JOB_COMMIT", "JOB_ABORT"))
+
     def __init__(self, eventQueue):
         self.eventsIn = deque()
         self.eventsOut = eventQueue
         # used to simulate async processing
-        self.sleepCounter = 10
+        self.nextHeartbeat = 0
     
     def heartbeat(self):
-        if self.sleepCounter != 0:
-            self.sleepCounter = self.sleepCounter - 1
+        if time.time() < self.nextHeartbeat:
+            pass
         elif len(self.eventsIn) > 0:
-            self.sleepCounter = 10
+            self.nextHeartbeat = time.time() + DELAY
             eventType, value = self.eventsIn.popleft()
             if eventType == "JOB_SETUP":
                 self.handleJobSetup(value)
@@ -20,8 +26,17 @@ class CommitterEventHandler(object):
             if eventType == "JOB_ABORT":
                 self.handleJobAbort(value)
         
+    # Seconds until heartbeat() next has work to do.
+    def timeout(self):
+        if len(self.eventsIn) == 0:
+            return None
+        return max(0, self.nextHeartbeat - time.time())
+
+    # Keep only the committer's own events; the queue carries every event
+    # of the scheduler, and one is handled per heartbeat.
     def pushNewEvents(self, newEvents):
-        self.eventsIn += newEvents
+        self.eventsIn.extend(event for event in newEvents
+                             if event[0] in self.eventTypes)
 
     def handleJobSetup(self, value):
         if True:
@@ -1,38 +1,112 @@
 from collections import deque
-# import time
+import time
+
+# Seconds the simulated ResourceManager takes to handle one event.
+DELAY = 0.005
 
 class RMContainerAllocator(object):
+    """Hands out containers: a container is a (worker locator, slot) pair.
+
+    Every worker has slot 0 as soon as its session opens; a REGISTER RPC
+    from the worker (see serverRegistered) advertises its other slots.
+    """
     def __init__(self, eventQueue, sessionManager):
-        self.assignedServers = []
+        self.assignedContainers = set()
         self.assignedTasks = {}
+        # locator -> number of slots the worker registered
+        self.serverSlots = {}
+        # slots of live workers with no assigned task
+        self.freeContainers = set((locator, 0) for locator in sessionManager.serverList())
         self.sessionManager = sessionManager
+        sessionManager.openHandlers.append(self.serverJoined)
+        sessionManager.closeHandlers.append(self.serverLeft)
         self.eventsIn = deque()
         self.eventsOut = eventQueue
+        # CONTAINER_REQ attempts waiting for a free server; requests withdrawn
+        # by a CONTAINER_DEALLOCATE leave requested and are skipped
+        self.pendingRequests = deque()
+        self.requested = set()
+        self.pendingMaps = 0
+        # speculative requests at the head of pendingRequests that no free
+        # server can take, until a server is released or joins
+        self.stalled = 0
+        # reduce attempt -> container, and the reduces already told to die
+        self.reduceAttempts = {}
+        self.preempted = set()
         # used to simulate async processing
-        self.sleepCounter = 10
+        self.nextHeartbeat = 0
         # self.time = time.time()
     
+    # Handle every event received since the last heartbeat, then match as
+    # many pending requests as possible against the free servers.
     def heartbeat(self):
-        if self.sleepCounter != 0:
-            self.sleepCounter = self.sleepCounter - 1
-        elif  len(self.eventsIn) > 0:
-            self.sleepCounter = 10
-            eventType, value = self.eventsIn.popleft()
-            if eventType == "CONTAINER_REQ":
-                taskAttempt, container = value
+        if time.time() < self.nextHeartbeat:
+            pass
+        elif len(self.eventsIn) > 0 or self.canAssign():
+            self.nextHeartbeat = time.time() + DELAY
+            while len(self.eventsIn) > 0:
+                eventType, value = self.eventsIn.popleft()
+                if eventType == "CONTAINER_REQ":
+                    taskAttempt, container = value
+                    if taskAttempt.stage == "MAP":
+                        self.pendingMaps += 1
+                    self.requested.add(taskAttempt)
+                    if taskAttempt.speculative:
+                        # a duplicate only helps if it runs before the original ends
+                        self.pendingRequests.appendleft(taskAttempt)
+                    else:
+                        self.pendingRequests.append(taskAttempt)
+                if eventType in ("CONTAINER_DEALLOCATE", "CONTAINER_FAILED"):
+                    taskAttempt, container = value
+                    self.containerDeallocate(taskAttempt, container)
+            waiting = []
+            self.stalled = 0
+            while self.canAssign():
+                taskAttempt = self.pendingRequests.popleft()
+                if taskAttempt not in self.requested:
+                    continue
                 container = self.containerRequest(taskAttempt)
                 if container == None:
-                    self.eventsIn.append((eventType, value))
+                    waiting.append(taskAttempt)
+                    continue
+                self.requested.discard(taskAttempt)
+                if taskAttempt.stage == "MAP":
+                    self.pendingMaps -= 1
                 else:
-                    self.eventsOut.append(("TA_ASSIGNED", (taskAttempt, container)))
-            if eventType in ("CONTAINER_DEALLOCATE", "CONTAINER_FAILED"):
-                taskAttempt, container = value
-                self.containerDeallocate(taskAttempt, container)
+                    self.reduceAttempts[taskAttempt] = container
+                self.eventsOut.append(("TA_ASSIGNED", (taskAttempt, container)))
+            self.pendingRequests.extendleft(reversed(waiting))
+            self.stalled = len(waiting)
+            self.preemptReduces()
             # if time.time() - self.time > 5:
             #     if len(self.assignedTasks) > 0:
             #         self.eventsOut.append(("TA_KILL", self.assignedTasks.items().pop()))
             #     self.time = time.time()
         
+    # Seconds until heartbeat() next has work to do; pending requests alone
+    # wait for a server to be released or to join.
+    def timeout(self):
+        if len(self.eventsIn) == 0 and not self.canAssign():
+            return None
+        return max(0, self.nextHeartbeat - time.time())
+
+    def canAssign(self):
+        return len(self.pendingRequests) > self.stalled and len(self.freeContainers) > 0
+
+    # Reduces wait for every map, so maps starved of containers by reduces
+    # would wait forever; kill reduces until the waiting maps fit (Hadoop's
+    # reduce preemption). The killed reduces ask for containers again.
+    def preemptReduces(self):
+        if len(self.freeContainers) > 0:
+            return
+        for taskAttempt, container in self.reduceAttempts.items():
+            if self.pendingMaps <= len(self.preempted):
+                break
+            if taskAttempt not in self.preempted:
+                print "Preempting reduce " + str(taskAttempt.work)
+                self.preempted.add(taskAttempt)
+                self.eventsOut.append(("TA_KILL", (taskAttempt, container)))
+
     def pushNewEvents(self, newEvents):
         self.eventsIn += newEvents
     
@@ -44,20 +118,64 @@ class RMContainerAllocator(object):
             return self.assignedTasks[taskAttempt]
 
         container = None
-        for locator in self.sessionManager.serverList():
-            if locator not in self.assignedServers:
-                container = locator
-                break
+        if taskAttempt.avoid == None:
+            if len(self.freeContainers) > 0:
+                container = self.freeContainers.pop()
+        else:
+            # a speculative attempt needs a different worker from its original
+            for free in self.freeContainers:
+                if free[0] != taskAttempt.avoid:
+                    container = free
+                    break
+            if container != None:
+                self.freeContainers.remove(container)
         if container != None:
             print "Container Chosen for work " + str(taskAttempt.work)
-            self.assignedServers.append(container)
+            self.assignedContainers.add(container)
             self.assignedTasks[taskAttempt] = container
         return container
     
     # handles ContainerAllocatorEvent::CONTAINER_DEALLOCATE functionalility
     # handles ContainerAllocatorEvent::CONTAINER_FAILED functionalility
     def containerDeallocate(self, taskAttempt, container):
-        if container in self.assignedServers:
-            self.assignedServers.remove(container)
+        if taskAttempt in self.requested:
+            # a request withdrawn before it was served
+            self.requested.remove(taskAttempt)
+            if taskAttempt.stage == "MAP":
+                self.pendingMaps -= 1
+        if container in self.assignedContainers:
+            self.assignedContainers.remove(container)
+            if container[0] in self.sessionManager.sessions:
+                self.freeContainers.add(container)
+                self.stalled = 0
         if taskAttempt in self.assignedTasks:
-            del self.assignedTasks[taskAttempt]
\ No newline at end of file
+            del self.assignedTasks[taskAttempt]
+        self.reduceAttempts.pop(taskAttempt, None)
+        self.preempted.discard(taskAttempt)
+
+    # Session open handler: a new server's first slot can be handed out.
+    def serverJoined(self, locator):
+        if (locator, 0) not in self.assignedContainers:
+            self.freeContainers.add((locator, 0))
+            self.stalled = 0
+
+    # Handler for the REGISTER RPC: a worker advertising its slot count.
+    def serverRegistered(self, rpc):
+        rpcType, slots = rpc.msg
+        if rpc.locator in self.sessionManager.sessions:
+            for slot in range(self.serverSlots.get(rpc.locator, 1), slots):
+                self.freeContainers.add((rpc.locator, slot))
+                self.stalled = 0
+            self.serverSlots[rpc.locator] = max(slots, self.serverSlots.get(rpc.locator, 1))
+        rpc.reply = slots
+        rpc.status = "send"
+
+    # Session close handler: a dead server's slots can no longer be handed out.
+    def serverLeft(self, locator):
+        for slot in range(self.serverSlots.pop(locator, 1)):
+            self.freeContainers.discard((locator, slot))
+            self.assignedContainers.discard((locator, slot))
+        for taskAttempt, container in self.reduceAttempts.items():
+            if container[0] == locator:
+                del self.reduceAttempts[taskAttempt]
+                self.preempted.discard(taskAttempt)
\ No newline at end of file
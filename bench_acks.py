@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""Acknowledgement benchmark.
+
+A client runs LAUNCH/COMMIT round trips against a server, both in this
+process and talking over loopback, as the master does against a worker's
+slots: each of a window of slots sends a LAUNCH, then a COMMIT once the
+LAUNCH is answered, then the next LAUNCH. The server answers after the given
+time. Compares acking every message and reply at once with a datagram of its
+own, as each message used to be acked, with cumulative acks that ride on the
+next packets to the peer, coalesced into datagrams, and are only sent alone
+if none go out in time. Reports datagrams per RPC and RPCs per second.
+
+Usage:
+    bench_acks.py [-n <trips>] [-w <window>] [-t <ms>]
+
+Options:
+  -h --help                 Show this screen.
+  -n --trips=<trips>        LAUNCH/COMMIT round trips [default: 10000].
+  -w --window=<window>      Slots running round trips at once [default: 16].
+  -t --times=<ms>           Comma separated times to answer in ms [default: 0,50].
+"""
+from docopt import docopt
+from rpc import RPC, RPCManager
+from session import MasterSessionManager, WorkerSessionManager, earliest
+from timer import TimerQueue
+
+from collections import deque
+import os
+import sys
+import time
+
+IP = "127.0.0.1"
+PORT = 8950
+
+# Make the manager ack every "msg" and "reply" packet it takes at once, alone.
+def ackEach(manager):
+    deliver = manager.deliver
+    def deliverAndAck(session, kind, rpcId, seq, data):
+        deliver(session, kind, rpcId, seq, data)
+        if seq != 0 and session.followed:
+            session.send("ack", 0, [seq])
+    manager.deliver = deliverAndAck
+
+def run(mode, trips, window, work):
+    timers = TimerQueue()
+    clientQ, serverQ = deque(), deque()
+    coalesce = (mode == "cumulative")
+    server = WorkerSessionManager(IP, PORT, IP, PORT + 1, serverQ, timers,
+                                  coalesce=coalesce)
+    client = MasterSessionManager(IP, PORT + 1, clientQ, timers,
+                                  coalesce=coalesce)
+    if mode == "per-packet":
+        ackEach(server)
+        ackEach(client)
+    serverRPC = RPCManager(server, serverQ)
+    clientRPC = RPCManager(client, clientQ)
+
+    def answer(rpc):
+        rpc.reply = rpc.msg
+        rpc.status = "send"
+    def serve(rpc):
+        if work == 0:
+            answer(rpc)
+        else:
+            rpc.status = "working"
+            timers.schedule(time.time() + work, answer, rpc)
+    serverRPC.handlers["LAUNCH"] = serve
+    serverRPC.handlers["COMMIT"] = serve
+
+    # slot -> its outstanding RPC
+    slots = {}
+    started = completed = 0
+    start = None
+    while completed < trips:
+        server.poll()
+        client.poll()
+        serverRPC.poll()
+        clientRPC.poll()
+        if start == None and len(client.sessions) > 0:
+            # the server's pings opened the session
+            start = time.time()
+            sent = client.datagramsSent() + server.datagramsSent()
+            locator = client.sessions.keys()[0]
+            for slot in range(window):
+                slots[slot] = None
+        for slot, rpc in slots.items():
+            if rpc != None and rpc.status != "complete":
+                continue
+            if rpc != None and rpc.msg[0] == "COMMIT":
+                completed += 1
+            if rpc != None and rpc.msg[0] == "LAUNCH":
+                rpc = RPC(locator, None, ("COMMIT", slot))
+            elif started < trips:
+                rpc = RPC(locator, None, ("LAUNCH", slot))
+                started += 1
+            else:
+                del slots[slot]
+                continue
+            clientRPC.send(rpc)
+            slots[slot] = rpc
+        client.flush()
+        timeouts = [server.timeout(), serverRPC.timeout(),
+                    clientRPC.timeout()]
+        server.wait(earliest(timeouts), [client.receiver])
+    elapsed = time.time() - start
+    # let the last acks go out
+    end = time.time() + 0.1
+    while time.time() < end:
+        server.poll()
+        client.poll()
+        client.flush()
+        server.wait(max(0, min(server.timeout(), end - time.time())),
+                    [client.receiver])
+    datagrams = client.datagramsSent() + server.datagramsSent() - sent
+    client.receiver.sock.close()
+    server.receiver.sock.close()
+    return elapsed, datagrams
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    trips = int(args['--trips'])
+    window = int(args['--window'])
+    print "{0:>12} {1:>8} {2:>14} {3:>10}".format(
+        "acks", "work ms", "datagrams/rpc", "rpcs/s")
+    for work in [float(t) / 1000 for t in args['--times'].split(",")]:
+        for mode in ("per-packet", "cumulative"):
+            # the sessions log every packet
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, "w")
+            elapsed, datagrams = run(mode, trips, window, work)
+            sys.stdout.close()
+            sys.stdout = stdout
+            print "{0:>12} {1:>8.0f} {2:>14.2f} {3:>10.0f}".format(
+                mode, work * 1000, float(datagrams) / (2 * trips),
+                2 * trips / elapsed)
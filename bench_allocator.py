@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""RMContainerAllocator allocation benchmark.
+
+Hands every worker's container out and takes it back again, comparing the
+indexed free-container set with the previous linear scan over serverList().
+The scan is cubic in the number of workers, so it runs with fewer of them.
+
+Usage:
+    bench_allocator.py [-w <wc>] [-s <sc>]
+
+Options:
+  -h --help                 Show this screen.
+  -w --workers=<wc>         Number of workers [default: 10000].
+  -s --scanworkers=<sc>     Number of workers for the scan [default: 1000].
+"""
+from docopt import docopt
+from RMContainerAllocator import RMContainerAllocator
+
+from collections import deque
+import os
+import sys
+import time
+
+class ScanAllocator(RMContainerAllocator):
+    """Allocator that scans serverList() and keeps a list of assigned servers."""
+    def __init__(self, eventQueue, sessionManager):
+        RMContainerAllocator.__init__(self, eventQueue, sessionManager)
+        self.assignedServers = []
+
+    def containerRequest(self, taskAttempt):
+        if taskAttempt in self.assignedTasks:
+            return self.assignedTasks[taskAttempt]
+        container = None
+        for locator in self.sessionManager.serverList():
+            if (locator, 0) not in self.assignedServers:
+                container = (locator, 0)
+                break
+        if container != None:
+            self.assignedServers.append(container)
+            self.assignedTasks[taskAttempt] = container
+        return container
+
+    def containerDeallocate(self, taskAttempt, container):
+        if container in self.assignedServers:
+            self.assignedServers.remove(container)
+        if taskAttempt in self.assignedTasks:
+            del self.assignedTasks[taskAttempt]
+
+class FakeSessionManager(object):
+    def __init__(self):
+        self.sessions = {}
+        self.openHandlers = []
+        self.closeHandlers = []
+
+    def join(self, locator):
+        self.sessions[locator] = None
+        for handler in self.openHandlers:
+            handler(locator)
+
+    def serverList(self):
+        return self.sessions.keys()
+
+class FakeAttempt(object):
+    def __init__(self, work):
+        self.work = work
+        self.avoid = None
+
+def measure(allocatorClass, workers):
+    sessionManager = FakeSessionManager()
+    allocator = allocatorClass(deque(), sessionManager)
+    for i in range(workers):
+        sessionManager.join(("127.0.0.1", 10000 + i, i))
+    attempts = [FakeAttempt(i) for i in range(workers)]
+    start = time.time()
+    containers = [allocator.containerRequest(a) for a in attempts]
+    allocated = time.time()
+    for a, c in zip(attempts, containers):
+        allocator.containerDeallocate(a, c)
+    released = time.time()
+    assert None not in containers
+    return (allocated - start) / workers, (released - allocated) / workers
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    stdout = sys.stdout
+    print "{0:>8} {1:>10} {2:>16} {3:>16}".format(
+        "", "workers", "us/allocation", "us/release")
+    for name, allocatorClass, workers in (
+            ("scan", ScanAllocator, int(args['--scanworkers'])),
+            ("indexed", RMContainerAllocator, int(args['--workers']))):
+        sys.stdout = open(os.devnull, "w")
+        allocation, release = measure(allocatorClass, workers)
+        sys.stdout = stdout
+        print "{0:>8} {1:>10} {2:>16.2f} {3:>16.2f}".format(
+            name, workers, allocation * 1e6, release * 1e6)
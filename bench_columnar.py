@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""Object-per-attempt Job versus ColumnarJob benchmark.
+
+Runs a whole Job to completion against an allocator and RPC layer that
+answer instantly, so the time measured is the scheduler's own. Each run
+happens in a fresh process so that its peak RSS can be reported.
+
+Usage:
+    bench_columnar.py [-s <sizes>] [-c <cc>]
+
+Options:
+  -h --help                 Show this screen.
+  -s --sizes=<sizes>        Comma separated task counts [default: 10000,100000,1000000].
+  -c --containers=<cc>      Number of containers to hand out [default: 1000].
+"""
+from docopt import docopt
+from job import Job
+from columnar import ColumnarJob
+from pool import Pool
+
+from multiprocessing import Process, Queue
+from collections import deque
+import os
+import resource
+import sys
+import time
+
+class InstantRPCManager(object):
+    def __init__(self):
+        self.pending = []
+
+    def send(self, rpc):
+        self.pending.append(rpc)
+        return rpc
+
+    def complete(self):
+        pending = self.pending
+        self.pending = []
+        for rpc in pending:
+            rpc.reply = rpc.msg
+            rpc.setStatus("complete")
+
+def respond(events, containers):
+    replies = []
+    for eventType, value in events:
+        if eventType == "JOB_SETUP":
+            replies.append(("JOB_SETUP_COMPLETED", value))
+        elif eventType == "JOB_COMMIT":
+            replies.append(("JOB_COMMIT_COMPLETED", value))
+        elif eventType == "CONTAINER_REQ":
+            taskAttempt, container = value
+            container = (("127.0.0.1", 9000 + len(replies) % containers, 0), 0)
+            replies.append(("TA_ASSIGNED", (taskAttempt, container)))
+    return replies
+
+def drive(jobClass, taskcount, containers):
+    pool = Pool()
+    rpcManager = InstantRPCManager()
+    eventQueue = deque()
+    job = jobClass(range(taskcount), pool, rpcManager, eventQueue)
+    passes = 0
+    start = time.time()
+    while job.getStatus() == "RUNNING":
+        events = list(eventQueue)
+        eventQueue.clear()
+        pool.pushNewEvents(respond(events, containers))
+        rpcManager.complete()
+        pool.poll()
+        passes += 1
+    return time.time() - start, passes
+
+def child(jobClass, taskcount, containers, results):
+    sys.stdout = open(os.devnull, "w")
+    elapsed, passes = drive(jobClass, taskcount, containers)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((elapsed, passes, rss))
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    containers = int(args['--containers'])
+    print "{0:>8} {1:>10} {2:>10} {3:>12} {4:>8} {5:>10}".format(
+        "backend", "tasks", "seconds", "tasks/s", "passes", "peak MB")
+    for taskcount in [int(s) for s in args['--sizes'].split(",")]:
+        for name, jobClass in (("object", Job), ("columnar", ColumnarJob)):
+            results = Queue()
+            p = Process(target=child, args=(jobClass, taskcount, containers, results))
+            p.start()
+            elapsed, passes, rss = results.get()
+            p.join()
+            print "{0:>8} {1:>10} {2:>10.2f} {3:>12.0f} {4:>8} {5:>10.1f}".format(
+                name, taskcount, elapsed, taskcount / elapsed, passes, rss / 1024.0)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""RPC table benchmark.
+
+A client sends echo RPCs to a server, both in this process and talking over
+loopback, keeping a window of them outstanding and dropping each once it
+completes, as the master and workers drop finished RPCs. Compares the RPC
+tables, which hold finished RPCs only while their owner does and served ones
+until their reply is sent, with tables that keep every RPC, as RPCManager
+used to. Reports the entries in both managers' tables, resident memory and
+microseconds per RPC at each checkpoint, memory as growth since the run
+started.
+
+Usage:
+    bench_gc.py [-n <rpcs>] [-c <checkpoints>] [-w <window>]
+
+Options:
+  -h --help                     Show this screen.
+  -n --rpcs=<rpcs>              RPCs sent per run [default: 100000].
+  -c --checkpoints=<count>      Times to report during a run [default: 5].
+  -w --window=<window>          RPCs outstanding at once [default: 16].
+"""
+from docopt import docopt
+from rpc import RPC, RPCManager
+from session import MasterSessionManager, WorkerSessionManager, earliest
+from timer import TimerQueue
+
+from collections import deque
+import os
+import sys
+import time
+
+IP = "127.0.0.1"
+PORT = 8960
+
+class RetainingRPCManager(RPCManager):
+    """Keeps every RPC it sends or serves."""
+    def __init__(self, sessionManager, inQ):
+        RPCManager.__init__(self, sessionManager, inQ)
+        self.outRPC["complete"] = {}
+        self.outRPC["failed"] = {}
+        self.served = {}
+
+    def transmitReply(self, rpc):
+        self.served[(rpc.locator, rpc.id)] = rpc
+        RPCManager.transmitReply(self, rpc)
+
+    def stats(self):
+        stats = RPCManager.stats(self)
+        stats["served"] = len(self.served)
+        return stats
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def echo(rpc):
+    rpc.reply = rpc.msg[1]
+    rpc.status = "send"
+
+def run(rpcClass, rpcs, checkpoints, window):
+    timers = TimerQueue()
+    clientQ, serverQ = deque(), deque()
+    server = MasterSessionManager(IP, PORT, serverQ, timers)
+    client = WorkerSessionManager(IP, PORT + 1, IP, PORT, clientQ, timers)
+    serverRPC = rpcClass(server, serverQ)
+    serverRPC.handlers["ECHO"] = echo
+    clientRPC = rpcClass(client, clientQ)
+
+    outstanding = []
+    sent = completed = 0
+    every = max(1, rpcs / checkpoints)
+    reports = []
+    base = rss()
+    start = last = None
+    while completed < rpcs:
+        client.poll()
+        server.poll()
+        clientRPC.poll()
+        serverRPC.poll()
+        done = [rpc for rpc in outstanding if rpc.status == "complete"]
+        outstanding = [rpc for rpc in outstanding if rpc.status != "complete"]
+        for rpc in done:
+            completed += 1
+            if completed % every == 0:
+                now = time.time()
+                reports.append((completed,
+                                sum(clientRPC.stats().values()) +
+                                sum(serverRPC.stats().values()),
+                                rss() - base, (now - last) / every * 1e6))
+                last = now
+        del done
+        if start == None and len(client.sessions) > 0:
+            start = last = time.time()
+        while start != None and len(outstanding) < window and sent < rpcs:
+            rpc = RPC(client.sessions.keys()[0], None, ("ECHO", sent))
+            clientRPC.send(rpc)
+            outstanding.append(rpc)
+            sent += 1
+        client.flush()
+        server.flush()
+        timeouts = [client.timeout(), clientRPC.timeout(),
+                    serverRPC.timeout()]
+        client.wait(earliest(timeouts), [server.receiver])
+    client.receiver.sock.close()
+    server.receiver.sock.close()
+    return reports
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    rpcs = int(args['--rpcs'])
+    checkpoints = int(args['--checkpoints'])
+    window = int(args['--window'])
+    print "{0:>10} {1:>10} {2:>10} {3:>8} {4:>8}".format(
+        "tables", "rpcs", "entries", "+rss MB", "us/rpc")
+    for name, rpcClass in (("retaining", RetainingRPCManager),
+                           ("collected", RPCManager)):
+        # the sessions log every packet
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        reports = run(rpcClass, rpcs, checkpoints, window)
+        sys.stdout.close()
+        sys.stdout = stdout
+        for completed, count, size, cost in reports:
+            print "{0:>10} {1:>10} {2:>10} {3:>8.1f} {4:>8.1f}".format(
+                name, completed, count, float(size) / 2 ** 20, cost)
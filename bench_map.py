@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""Map execution benchmark.
+
+Writes a set of text input files and runs a named map function over all of
+them with functions.runMap in a process pool of each given size, as a
+worker with that many slots would, reporting the input and output rates.
+
+Usage:
+    bench_map.py [-m <map>] [-f <fc>] [-l <lc>] [-p <sizes>] [-d <dir>]
+
+Options:
+  -h --help                 Show this screen.
+  -m --map=<map>            Map function to run [default: wordcount].
+  -f --files=<fc>           Number of input files [default: 8].
+  -l --lines=<lc>           Lines per input file [default: 50000].
+  -p --pools=<sizes>        Comma separated pool sizes [default: 1,2,4].
+  -d --dir=<dir>            Scratch directory [default: /tmp/mappy-bench].
+"""
+from docopt import docopt
+from functions import mapWork, runMap
+from inputformat import wholeFile
+
+from multiprocessing import Pool
+from random import choice, seed
+import os
+import shutil
+import time
+
+WORDS = ["map", "reduce", "task", "attempt", "container", "worker", "master",
+         "shuffle", "commit", "rule"]
+
+def writeInput(directory, files, lines):
+    seed(0)
+    paths = []
+    for i in range(files):
+        path = os.path.join(directory, "input-{0}.txt".format(i))
+        with open(path, "w") as f:
+            for j in range(lines):
+                f.write(" ".join(choice(WORDS) for k in range(10)) + "\n")
+        paths.append(path)
+    return paths
+
+def measure(mapName, paths, directory, size):
+    pool = Pool(size)
+    work = [(mapWork(i, mapName, wholeFile(path), 1),
+             os.path.join(directory, "map-{0}.out".format(i)))
+            for i, path in enumerate(paths)]
+    start = time.time()
+    results = pool.map(runMapArgs, work)
+    elapsed = time.time() - start
+    pool.close()
+    pool.join()
+    assert "failed" not in results
+    return elapsed, sum(r[0] for r in results), sum(r[1] for r in results)
+
+def runMapArgs(args):
+    return runMap(*args)
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    directory = args['--dir']
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = writeInput(directory, int(args['--files']), int(args['--lines']))
+    print "{0:>6} {1:>10} {2:>10} {3:>14}".format(
+        "procs", "seconds", "MB/s", "records/s")
+    for size in [int(s) for s in args['--pools'].split(",")]:
+        elapsed, records, inputBytes = measure(args['--map'], paths, directory, size)
+        print "{0:>6} {1:>10.2f} {2:>10.2f} {3:>14.0f}".format(
+            size, elapsed, inputBytes / elapsed / 1e6, records / elapsed)
+    shutil.rmtree(directory)
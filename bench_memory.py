@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""Scheduler memory benchmark.
+
+Builds a Job, then reports the growth in resident memory per Task once the
+tasks exist and per TaskAttempt once every attempt has been assigned a
+container and sent its LAUNCH RPC.
+
+Usage:
+    bench_memory.py [-t <tc>]
+
+Options:
+  -h --help                 Show this screen.
+  -t --taskcount=<tc>       Number of tasks in the job [default: 1000000].
+"""
+from docopt import docopt
+from bench_pool import NullRPCManager
+from job import Job
+from pool import Pool
+
+from collections import deque
+import gc
+import os
+import sys
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+def measure(taskcount):
+    pool = Pool()
+    rpcManager = NullRPCManager()
+    eventQueue = deque()
+    work = range(taskcount)
+    job = Job(work, pool, rpcManager, eventQueue)
+    job.setup = True
+    gc.collect()
+    base = rss()
+    # Rule 5: create the tasks.
+    pool.poll()
+    gc.collect()
+    tasks = rss()
+    # Task Rule 3 adds the attempts; they request containers, get them and launch.
+    pool.poll()
+    pool.poll()
+    eventQueue.clear()
+    pool.pushNewEvents([("TA_ASSIGNED", (taskAttempt, (("127.0.0.1", 8001, 0), 0)))
+                        for task in job.taskList
+                        for taskAttempt in task.taskAttempts])
+    pool.poll()
+    pool.poll()
+    eventQueue.clear()
+    gc.collect()
+    attempts = rss()
+    return (tasks - base) / float(taskcount), (attempts - tasks) / float(taskcount)
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    taskcount = int(args['--taskcount'])
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    perTask, perAttempt = measure(taskcount)
+    sys.stdout = stdout
+    print "tasks: {0}".format(taskcount)
+    print "bytes per task:    {0:.0f}".format(perTask)
+    print "bytes per attempt: {0:.0f} (including its LAUNCH RPC)".format(perAttempt)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""Pool rule-evaluation benchmark.
+
+Runs a Job whose TaskAttempts are all launched and waiting on their LAUNCH
+RPCs, completing a fraction of those RPCs before every pass, and compares
+the wakeup-driven Pool against a Pool that re-runs every active task on
+every pass.
+
+Usage:
+    bench_pool.py [-t <tc>] [-p <passes>] [-c <cr>]
+
+Options:
+  -h --help                 Show this screen.
+  -t --taskcount=<tc>       Number of tasks in the job [default: 50000].
+  -p --passes=<passes>      Number of Pool.poll() passes to time [default: 20].
+  -c --complete=<cr>        Fraction of RPCs completed per pass [default: 0.001].
+"""
+from docopt import docopt
+from job import Job
+from pool import Pool
+
+from collections import deque
+import os
+import sys
+import time
+
+class FullScanPool(Pool):
+    """Pool that re-runs every active task on every pass."""
+    def poll(self):
+        self.timers.expire()
+        for t in list(self.taskSet):
+            t.handleEvents(self.takeEvents(t))
+            t.applyRules()
+            self.evaluations += 1
+
+class NullRPCManager(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, rpc):
+        self.sent.append(rpc)
+        return rpc
+
+def setup(poolClass, taskcount):
+    pool = poolClass()
+    rpcManager = NullRPCManager()
+    eventQueue = deque()
+    job = Job(range(taskcount), pool, rpcManager, eventQueue)
+    job.setup = True
+    # Create tasks and attempts, then hand every attempt a container.
+    for i in range(3):
+        pool.poll()
+    pool.pushNewEvents([("TA_ASSIGNED", (taskAttempt, (("127.0.0.1", 8001, 0), 0)))
+                        for task in job.taskList
+                        for taskAttempt in task.taskAttempts])
+    # Send every LAUNCH RPC.
+    for i in range(2):
+        pool.poll()
+    eventQueue.clear()
+    return pool, rpcManager
+
+def measure(poolClass, taskcount, passes, completeRate):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        pool, rpcManager = setup(poolClass, taskcount)
+    finally:
+        sys.stdout = stdout
+    pending = list(rpcManager.sent)
+    perPass = int(len(pending) * completeRate)
+    pool.evaluations = 0
+    elapsed = 0.0
+    for i in range(passes):
+        for j in range(perPass):
+            rpc = pending.pop()
+            rpc.reply = rpc.msg
+            rpc.setStatus("complete")
+        start = time.time()
+        pool.poll()
+        elapsed += time.time() - start
+    return pool.evaluations, elapsed
+
+def report(name, evaluations, elapsed, passes):
+    print "{0:>10}: {1:>10.0f} evals/pass {2:>12.0f} evals/s {3:>10.1f} passes/s".format(
+        name, evaluations / float(passes), evaluations / elapsed, passes / elapsed)
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    taskcount = int(args['--taskcount'])
+    passes = int(args['--passes'])
+    completeRate = float(args['--complete'])
+    for name, poolClass in (("full scan", FullScanPool), ("wakeup", Pool)):
+        evaluations, elapsed = measure(poolClass, taskcount, passes, completeRate)
+        report(name, evaluations, elapsed, passes)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""Receive path benchmark.
+
+Compares net.RecvPipe, which reads the socket in the receiving process a
+batch at a time, with the listener process it replaced, which received each
+datagram with recvfrom and piped it to the receiving process. Another
+process sends a stream of datagrams a window at a time, waiting for the
+receiver to have handled each window, and the rate at which they are
+received is reported; then a process echoes datagrams one at a time, and
+the round trip time is reported.
+
+Usage:
+    bench_recv.py [-n <packets>] [-s <size>] [-w <window>] [-e <echoes>]
+
+Options:
+  -h --help                 Show this screen.
+  -n --packets=<packets>    Datagrams in the stream [default: 100000].
+  -s --size=<size>          Bytes per datagram [default: 100].
+  -w --window=<window>      Datagrams sent before waiting [default: 128].
+  -e --echoes=<echoes>      Round trips timed [default: 5000].
+"""
+from docopt import docopt
+from net import RCVBUF, RecvPipe
+
+from multiprocessing import Pipe, Process
+import select
+import socket
+import time
+
+IP = "127.0.0.1"
+PORT = 8700
+ECHO_PORT = 8701
+# Seconds without a datagram after which the rest of a stream is lost.
+IDLE = 0.5
+
+class ProcessRecvPipe(object):
+    """The old receive path: a process receives and pipes every datagram.
+    It gets the same socket buffer as RecvPipe."""
+    def __init__(self, IP, PORT):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((IP, PORT))
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+        self.reader, self.writer = Pipe(duplex=False)
+        self.listener = Process(target=ProcessRecvPipe.listen, args=(self,))
+        self.listener.daemon = True
+        self.listener.start()
+
+    def listen(self):
+        while True:
+            self.writer.send(self.sock.recvfrom(1024))
+
+    def recvBatch(self):
+        packets = []
+        while self.reader.poll():
+            packets.append(self.reader.recv()[0])
+        return packets
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def close(self):
+        self.listener.terminate()
+        self.listener.join()
+        self.sock.close()
+
+def makeReceiver(name, port):
+    if name == "process":
+        return ProcessRecvPipe(IP, port)
+    return RecvPipe(IP, port)
+
+def closeReceiver(receiver):
+    if isinstance(receiver, ProcessRecvPipe):
+        receiver.close()
+    else:
+        receiver.sock.close()
+
+def stream(packets, size, window, conn):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    data = "x" * size
+    for i in xrange(packets):
+        sock.sendto(data, (IP, PORT))
+        if (i + 1) % window == 0:
+            # the receiver's go-ahead, or the end of a lossy stream
+            if not conn.poll(IDLE * 2):
+                return
+            conn.recv()
+
+def measureStream(name, packets, size, window):
+    receiver = makeReceiver(name, PORT)
+    conn, senderConn = Pipe()
+    sender = Process(target=stream, args=(packets, size, window, senderConn))
+    received = 0
+    handled = 0
+    start = time.time()
+    last = start
+    sender.start()
+    while received < packets:
+        readable = select.select([receiver], [], [], IDLE)[0]
+        if len(readable) == 0:
+            break
+        for packet in receiver.recvBatch():
+            # touch the data as a decoder would
+            handled += len(packet[:8])
+            received += 1
+            if received % window == 0:
+                conn.send(None)
+        last = time.time()
+    sender.join()
+    closeReceiver(receiver)
+    return received, last - start
+
+def echo(name):
+    receiver = makeReceiver(name, ECHO_PORT)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    while True:
+        select.select([receiver], [], [])
+        for packet in receiver.recvBatch():
+            if len(packet) == 0:
+                closeReceiver(receiver)
+                return
+            sock.sendto(packet, (IP, PORT))
+
+def measureEcho(name, echoes, size):
+    receiver = RecvPipe(IP, PORT)
+    server = Process(target=echo, args=(name,))
+    server.start()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    data = "x" * size
+    # wait for the server to be listening
+    while len(select.select([receiver], [], [], 0)[0]) == 0:
+        sock.sendto(data, (IP, ECHO_PORT))
+        time.sleep(0.1)
+    time.sleep(0.2)
+    receiver.recvBatch()
+    start = time.time()
+    for i in xrange(echoes):
+        sock.sendto(data, (IP, ECHO_PORT))
+        select.select([receiver], [], [])
+        receiver.recvBatch()
+    elapsed = time.time() - start
+    sock.sendto("", (IP, ECHO_PORT))
+    server.join()
+    closeReceiver(receiver)
+    return elapsed / echoes
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    packets = int(args['--packets'])
+    size = int(args['--size'])
+    print "{0:>10} {1:>10} {2:>12} {3:>8} {4:>10}".format(
+        "path", "received", "packets/s", "lost %", "rtt us")
+    for name in ("process", "inline"):
+        received, elapsed = measureStream(name, packets, size,
+                                          int(args['--window']))
+        rtt = measureEcho(name, int(args['--echoes']), size)
+        print "{0:>10} {1:>10} {2:>12.0f} {3:>8.1f} {4:>10.1f}".format(
+            name, received, received / elapsed,
+            100.0 * (packets - received) / packets, rtt * 1e6)
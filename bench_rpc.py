@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+"""RPC retransmission benchmark.
+
+A client sends echo RPCs to a server, both in this process and talking over
+loopback, keeping a window of them outstanding. Both ends drop each datagram
+they send with the given probability and hold each one back for the given
+delay, as a lossy or slow link would. Compares the fixed 0.25 second
+retransmission timeout RPCManager used to have with the per-session
+adaptive RTO and exponential backoff, reporting goodput, retransmissions per
+RPC and the smoothed round trip time the client measured. With --check it
+doubles as a regression test: every RPC must complete however many of its
+packets or fragments are lost or reordered.
+
+Usage:
+    bench_rpc.py [-c] [-n <rpcs>] [-w <window>] [-s <size>] [-l <losses>] [-d <delays>]
+
+Options:
+  -h --help                 Show this screen.
+  -c --check                Exit with status 1 unless every run completes.
+  -n --rpcs=<rpcs>          RPCs sent per run [default: 1000].
+  -w --window=<window>      RPCs outstanding at once [default: 16].
+  -s --size=<size>          Bytes of payload per RPC [default: 200].
+  -l --losses=<losses>      Comma separated loss rates [default: 0,0.05,0.2].
+  -d --delays=<delays>      Comma separated one-way delays in ms [default: 0,150].
+"""
+from docopt import docopt
+from rpc import RPC, RPCManager
+from session import MasterSessionManager, WorkerSessionManager, earliest
+from timer import TimerQueue
+
+from collections import deque
+import os
+import random
+import sys
+import time
+
+IP = "127.0.0.1"
+PORT = 8900
+# Seconds after which a run is abandoned.
+LIMIT = 120
+# The old retransmission timeout.
+FIXED_RTO = 0.25
+
+class FixedRPCManager(RPCManager):
+    """Resends every unacked message or reply FIXED_RTO seconds after its
+    last transmission."""
+    def rto(self, rpc):
+        return FIXED_RTO
+
+def echo(rpc):
+    rpc.reply = rpc.msg[1]
+    rpc.status = "send"
+
+# Drop or delay every datagram the manager sends.
+def impair(manager, timers, rng, loss, delay):
+    send = manager.sender.send
+    def deliver(datagram):
+        send(*datagram)
+    def impaired(data, address):
+        if rng.random() < loss:
+            return
+        if delay > 0:
+            timers.schedule(time.time() + delay, deliver, (data, address))
+        else:
+            send(data, address)
+    manager.sender.send = impaired
+
+def run(rpcClass, rpcs, window, size, loss, delay):
+    timers = TimerQueue()
+    clientQ, serverQ = deque(), deque()
+    server = MasterSessionManager(IP, PORT, serverQ, timers)
+    client = WorkerSessionManager(IP, PORT + 1, IP, PORT, clientQ, timers)
+    serverRPC = rpcClass(server, serverQ)
+    serverRPC.handlers["ECHO"] = echo
+    clientRPC = rpcClass(client, clientQ)
+    rng = random.Random(0)
+    impair(server, timers, rng, loss, delay)
+    impair(client, timers, rng, loss, delay)
+
+    outstanding = []
+    sent = completed = failed = 0
+    payload = "x" * size
+    start = time.time()
+    while True:
+        client.poll()
+        server.poll()
+        clientRPC.poll()
+        serverRPC.poll()
+        for rpc in outstanding:
+            if rpc.status in ("complete", "failed"):
+                if rpc.status == "complete":
+                    completed += 1
+                else:
+                    failed += 1
+        outstanding = [rpc for rpc in outstanding
+                       if rpc.status not in ("complete", "failed")]
+        if completed + failed == rpcs or time.time() > start + LIMIT:
+            break
+        while (len(client.sessions) > 0 and len(outstanding) < window and
+               sent < rpcs):
+            rpc = RPC(client.sessions.keys()[0], None, ("ECHO", payload))
+            clientRPC.send(rpc)
+            outstanding.append(rpc)
+            sent += 1
+        # the delayed datagrams are timers, so flush before asking for them
+        client.flush()
+        server.flush()
+        timeouts = [client.timeout(), clientRPC.timeout(),
+                    serverRPC.timeout()]
+        client.wait(earliest(timeouts), [server.receiver])
+    elapsed = time.time() - start
+
+    stats = client.stats().values()
+    if len(stats) == 0:
+        stats = [{"srtt": None, "retransmits": 0}]
+    client.receiver.sock.close()
+    server.receiver.sock.close()
+    return elapsed, completed, stats[0]["retransmits"], stats[0]["srtt"]
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    rpcs = int(args['--rpcs'])
+    window = int(args['--window'])
+    size = int(args['--size'])
+    incomplete = 0
+    print "{0:>6} {1:>6} {2:>9} {3:>10} {4:>10} {5:>11} {6:>9}".format(
+        "loss", "ms", "rto", "done", "KB/s", "resends/rpc", "srtt ms")
+    for loss in [float(l) for l in args['--losses'].split(",")]:
+        for delay in [float(d) / 1000 for d in args['--delays'].split(",")]:
+            for name, rpcClass in (("fixed", FixedRPCManager),
+                                   ("adaptive", RPCManager)):
+                # the sessions log every packet
+                stdout = sys.stdout
+                sys.stdout = open(os.devnull, "w")
+                elapsed, completed, retransmits, srtt = run(
+                    rpcClass, rpcs, window, size, loss, delay)
+                sys.stdout.close()
+                sys.stdout = stdout
+                if completed < rpcs:
+                    incomplete += 1
+                print "{0:>6} {1:>6.0f} {2:>9} {3:>10} {4:>10.1f} {5:>11.2f} {6:>9}".format(
+                    loss, delay * 1000, name, completed,
+                    completed * size / elapsed / 1024,
+                    float(retransmits) / rpcs,
+                    "" if srtt == None else "{0:.1f}".format(srtt * 1000))
+    if args['--check'] and incomplete > 0:
+        print "{0} runs left RPCs unfinished".format(incomplete)
+        sys.exit(1)
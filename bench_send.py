@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""Send path benchmark.
+
+A SessionManager sends an ack, a reply and a ping to each of many peers per
+pass of its event loop, as the master does to busy workers, and every peer
+socket is drained after each pass. Compares the old send path, where each
+session had its own socket and sent every packet at once, with the shared
+socket of session.py sending every packet at once and coalescing the packets
+to a peer into one datagram per pass. Reports messages per second, datagrams
+(sendto calls) per message and sockets held.
+
+Usage:
+    bench_send.py [-p <peers>] [-n <passes>]
+
+Options:
+  -h --help                 Show this screen.
+  -p --peers=<peers>        Peer sessions [default: 200].
+  -n --passes=<passes>      Event loop passes [default: 200].
+"""
+from docopt import docopt
+from session import Session, SessionManager
+
+from collections import deque
+import errno
+import os
+import socket
+import sys
+import time
+
+IP = "127.0.0.1"
+PORT = 8800
+# The packets sent to each peer per pass, as (kind, payload).
+PACKETS = [("ack", None), ("reply", ["LAUNCH", [17, 1]]), ("ping", None)]
+
+class OldSession(Session):
+    """A session sending through a socket of its own, one sendto per
+    packet."""
+    def __init__(self, IP, PORT, ID, manager):
+        Session.__init__(self, IP, PORT, ID, manager)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.datagrams = 0
+
+    def send(self, kind, rpcId=0, payload=None):
+        print "TX: ", self.locator, kind, rpcId, payload
+        self.sock.sendto(self.manager.encoder.encode(kind, rpcId, payload),
+                         self.address)
+        self.datagrams += 1
+
+def makePeers(count):
+    peers = []
+    for i in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((IP, PORT + 1 + i))
+        sock.setblocking(False)
+        peers.append(sock)
+    return peers
+
+def drain(peers):
+    received = 0
+    for sock in peers:
+        while True:
+            try:
+                sock.recv(2048)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            received += 1
+    return received
+
+def measure(name, peers, passes):
+    manager = SessionManager(IP, PORT, deque(), coalesce=(name == "coalesced"))
+    sessionClass = OldSession if name == "per-session" else Session
+    sessions = [sessionClass(IP, PORT + 1 + i, i, manager)
+                for i in range(len(peers))]
+    received = 0
+    elapsed = 0
+    # the sessions log every packet
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    for n in xrange(passes):
+        start = time.time()
+        for session in sessions:
+            for kind, payload in PACKETS:
+                session.send(kind, n + 1, payload)
+        manager.flush()
+        elapsed += time.time() - start
+        received += drain(peers)
+    sys.stdout.close()
+    sys.stdout = stdout
+    if name == "per-session":
+        datagrams = sum(session.datagrams for session in sessions)
+        sockets = len(sessions)
+    else:
+        datagrams = manager.datagramsSent()
+        sockets = 1
+    manager.receiver.sock.close()
+    return elapsed, datagrams, received, sockets
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    passes = int(args['--passes'])
+    peers = makePeers(int(args['--peers']))
+    messages = passes * len(peers) * len(PACKETS)
+    print "{0:>12} {1:>12} {2:>14} {3:>10} {4:>8}".format(
+        "path", "messages/s", "datagrams/msg", "received", "sockets")
+    for name in ("per-session", "shared", "coalesced"):
+        elapsed, datagrams, received, sockets = measure(name, peers, passes)
+        print "{0:>12} {1:>12.0f} {2:>14.2f} {3:>10} {4:>8}".format(
+            name, messages / elapsed, float(datagrams) / messages, received,
+            sockets)
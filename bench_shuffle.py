@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+"""Shuffle benchmark.
+
+Writes a set of partitioned map outputs and has every reducer fetch its
+partition of each of them from a local ShuffleServer, with a pool of
+fetcher threads per reducer as a worker runs them, once with the server
+sending partitions straight from a memory map and once with it reading each
+partition into memory first. Reports the rate at which the data arrived.
+
+Usage:
+    bench_shuffle.py [-m <mc>] [-r <rc>] [-s <size>] [-f <fetchers>] [-d <dir>]
+
+Options:
+  -h --help                 Show this screen.
+  -m --maps=<mc>            Number of map outputs [default: 16].
+  -r --reduces=<rc>         Number of reducers, run one after another [default: 4].
+  -s --size=<size>          MB of output per map [default: 16].
+  -f --fetchers=<fetchers>  Fetches each reducer runs at once [default: 5].
+  -d --dir=<dir>            Scratch directory [default: /tmp/mappy-bench].
+"""
+from docopt import docopt
+from functions import indexPath
+from shuffle import ShuffleServer, fetch, mapOutputPath
+
+from multiprocessing.pool import ThreadPool
+import json
+import os
+import shutil
+import time
+
+PORT = 8900
+
+def writeOutputs(directory, maps, reduces, size):
+    length = size * (1 << 20) / reduces
+    data = "x" * length
+    for taskId in range(maps):
+        path = mapOutputPath(directory, taskId)
+        with open(path, "wb") as output:
+            for partition in range(reduces):
+                output.write(data)
+        with open(indexPath(path), "w") as index:
+            json.dump([[p * length, length] for p in range(reduces)], index)
+
+def fetchArgs(args):
+    return fetch(*args)
+
+def measure(directory, maps, reduces, fetchers, zeroCopy, port):
+    server = ShuffleServer("127.0.0.1", port, directory, zeroCopy)
+    server.start()
+    pool = ThreadPool(fetchers)
+    fetched = 0
+    start = time.time()
+    for partition in range(reduces):
+        work = [(("127.0.0.1", port), taskId, partition,
+                 os.path.join(directory, "segment-{0}".format(taskId)))
+                for taskId in range(maps)]
+        results = pool.map(fetchArgs, work)
+        assert "failed" not in results
+        fetched += sum(results)
+    elapsed = time.time() - start
+    pool.close()
+    server.shutdown()
+    server.server_close()
+    return elapsed, fetched
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    directory = args['--dir']
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    maps = int(args['--maps'])
+    reduces = int(args['--reduces'])
+    writeOutputs(directory, maps, reduces, int(args['--size']))
+    print "{0:>10} {1:>10} {2:>10}".format("server", "seconds", "MB/s")
+    for port, (name, zeroCopy) in enumerate((("mmap", True), ("read", False)), PORT):
+        elapsed, fetched = measure(directory, maps, reduces,
+                                   int(args['--fetchers']), zeroCopy, port)
+        print "{0:>10} {1:>10.2f} {2:>10.1f}".format(
+            name, elapsed, fetched / elapsed / 1e6)
+    shutil.rmtree(directory)
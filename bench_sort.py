@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""Map output sort-and-spill benchmark.
+
+Writes one text input file and runs a map over it with functions.runMap
+under each given buffer limit, with and without a combiner, each run in a
+fresh process. Reports the time, the growth of the process's peak resident
+memory during the map, and the bytes of output left for the reducers.
+
+Usage:
+    bench_sort.py [-m <map>] [-c <combiner>] [-l <lc>] [-r <rc>] [-b <limits>] [-d <dir>]
+
+Options:
+  -h --help                 Show this screen.
+  -m --map=<map>            Map function to run [default: wordcount].
+  -c --combiner=<combiner>  Reduce function used as the combiner [default: sum].
+  -l --lines=<lc>           Lines of input [default: 50000].
+  -r --reduces=<rc>         Number of partitions [default: 4].
+  -b --limits=<limits>      Comma separated buffer limits in MB [default: 1000,16,4].
+  -d --dir=<dir>            Scratch directory [default: /tmp/mappy-bench].
+"""
+from docopt import docopt
+from bench_map import writeInput
+from functions import mapWork, runMap
+from inputformat import wholeFile
+
+from multiprocessing import Pipe, Process
+import os
+import resource
+import shutil
+
+def measure(work, outputPath, limit, conn):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = runMap(work, outputPath, limit)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send([result, (after - before) / 1024.0, os.path.getsize(outputPath)])
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    directory = args['--dir']
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = writeInput(directory, 1, int(args['--lines']))[0]
+    outputPath = os.path.join(directory, "map-0.out")
+    print "{0:>10} {1:>10} {2:>10} {3:>12} {4:>12}".format(
+        "limit MB", "combiner", "seconds", "peak +MB", "output MB")
+    for limit in [float(l) for l in args['--limits'].split(",")]:
+        for combiner in (None, args['--combiner']):
+            work = mapWork(0, args['--map'], wholeFile(path),
+                           int(args['--reduces']), combiner)
+            reader, writer = Pipe(duplex=False)
+            process = Process(target=measure,
+                              args=(work, outputPath, int(limit * (1 << 20)), writer))
+            process.start()
+            result, peak, output = reader.recv()
+            process.join()
+            assert result != "failed"
+            print "{0:>10} {1:>10} {2:>10.2f} {3:>12.1f} {4:>12.2f}".format(
+                limit, combiner, result[2], peak, output / 1e6)
+    shutil.rmtree(directory)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""Speculative execution benchmark.
+
+Runs the same Jobs with and without a Speculator against simulated workers
+that take worker.py's randomized times (scaled down), where a fraction of
+the attempts are stragglers that run several times longer, and reports the
+job latencies.
+
+Usage:
+    bench_speculation.py [-c] [-t <tc>] [-w <wc>] [-r <runs>] [-p <sp>] [-f <sf>] [-s <scale>]
+
+Options:
+  -h --help                 Show this screen.
+  -c --columnar             Use ColumnarJob (needs numpy).
+  -t --taskcount=<tc>       Number of tasks in each job [default: 100].
+  -w --workers=<wc>         Number of single slot workers [default: 50].
+  -r --runs=<runs>          Number of jobs run with each policy [default: 5].
+  -p --stragglers=<sp>      Fraction of attempts that straggle [default: 0.05].
+  -f --factor=<sf>          How many times longer a straggler runs [default: 10].
+  -s --scale=<scale>        Seconds per second of worker.py time [default: 0.02].
+"""
+from docopt import docopt
+from bench_allocator import FakeSessionManager
+from RMContainerAllocator import RMContainerAllocator
+from CommitterEventHandler import CommitterEventHandler
+from job import Job
+from pool import Pool
+from session import earliest
+from speculator import Speculator
+from timer import TimerQueue
+
+from collections import deque
+from random import gauss, random, seed
+import os
+import sys
+import time
+
+class TimedRPCManager(object):
+    """Completes RPCs after the times worker.py -r would take."""
+    def __init__(self, timers, scale, stragglers, factor):
+        self.timers = timers
+        self.scale = scale
+        self.stragglers = stragglers
+        self.factor = factor
+        # container -> RPC it is working on
+        self.working = {}
+
+    def send(self, rpc):
+        rpcType, (work, slot) = rpc.msg
+        container = (rpc.locator, slot)
+        if rpcType == "LAUNCH":
+            runtime = 5.0 + gauss(0.0, 1.0)
+            if random() < self.stragglers:
+                runtime *= self.factor
+        elif rpcType == "COMMIT":
+            runtime = 2.0 + gauss(0.0, 1.0)
+        else:
+            # cleanup interrupts whatever the container is doing
+            self.finish(self.working.get(container), "failed")
+            runtime = 1.0 + gauss(0.0, 1.0)
+        self.working[container] = rpc
+        rpc.timer = self.timers.schedule(
+            time.time() + max(0.0, runtime) * self.scale, self.complete, rpc)
+        return rpc
+
+    def complete(self, rpc):
+        self.finish(rpc, rpc.msg)
+
+    def finish(self, rpc, reply):
+        if rpc == None or rpc.status == "complete":
+            return
+        self.timers.cancel(rpc.timer)
+        rpc.reply = reply
+        rpc.setStatus("complete")
+
+def runJob(jobClass, speculator, args):
+    timers = TimerQueue()
+    pool = Pool(timers)
+    eventQueue = deque()
+    sessionManager = FakeSessionManager()
+    allocator = RMContainerAllocator(eventQueue, sessionManager)
+    for i in range(int(args['--workers'])):
+        sessionManager.join(("127.0.0.1", 10000 + i, i))
+    committer = CommitterEventHandler(eventQueue)
+    rpcManager = TimedRPCManager(timers, float(args['--scale']),
+                                 float(args['--stragglers']),
+                                 float(args['--factor']))
+    job = jobClass(range(int(args['--taskcount'])), pool, rpcManager,
+                   eventQueue, speculator)
+    start = time.time()
+    while job.getStatus() == "RUNNING":
+        allocator.pushNewEvents(eventQueue)
+        committer.pushNewEvents(eventQueue)
+        pool.pushNewEvents(eventQueue)
+        eventQueue.clear()
+        allocator.heartbeat()
+        committer.heartbeat()
+        pool.poll()
+        timeouts = [allocator.timeout(), committer.timeout(), pool.timeout()]
+        if len(eventQueue) > 0:
+            timeouts.append(0)
+        delay = earliest(timeouts)
+        if delay > 0:
+            time.sleep(delay)
+    return time.time() - start
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    jobClass = Job
+    if args['--columnar']:
+        from columnar import ColumnarJob
+        jobClass = ColumnarJob
+    scale = float(args['--scale'])
+    runs = int(args['--runs'])
+    stdout = sys.stdout
+    print "{0:>12} {1:>10} {2:>10} {3:>10} {4:>12}".format(
+        "", "mean s", "median s", "worst s", "speculated")
+    for name in ("none", "speculator"):
+        latencies = []
+        speculated = 0
+        for run in range(runs):
+            seed(run)
+            speculator = None
+            if name == "speculator":
+                speculator = Speculator(interval=scale)
+            sys.stdout = open(os.devnull, "w")
+            latencies.append(runJob(jobClass, speculator, args))
+            sys.stdout = stdout
+            if speculator != None:
+                speculated += speculator.launched
+        latencies.sort()
+        print "{0:>12} {1:>10.2f} {2:>10.2f} {3:>10.2f} {4:>12}".format(
+            name, sum(latencies) / runs, latencies[runs / 2], latencies[-1],
+            speculated)
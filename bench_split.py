@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""Input split benchmark.
+
+Writes one large text file, splits it with inputformat.getSplits at each
+given split size and reads every split's lines with inputformat.readSplit in
+a process pool, as that many map slots would. Reports the time to make the
+splits, which never reads the file, and the rate at which the splits were
+read, against one process iterating over the whole file.
+
+Usage:
+    bench_split.py [-s <mb>] [-b <sizes>] [-p <procs>] [-d <dir>]
+
+Options:
+  -h --help                 Show this screen.
+  -s --size=<mb>            MB of input [default: 256].
+  -b --splits=<sizes>       Comma separated split sizes in MB [default: 64,16,4].
+  -p --procs=<procs>        Processes reading splits at once [default: 4].
+  -d --dir=<dir>            Scratch directory [default: /tmp/mappy-bench].
+"""
+from docopt import docopt
+from bench_map import WORDS
+from inputformat import getSplits, readSplit
+
+from multiprocessing import Pool
+from random import choice, seed
+import os
+import shutil
+import time
+
+def writeInput(path, size):
+    seed(0)
+    lines = [" ".join(choice(WORDS) for k in range(10)) + "\n"
+             for j in range(10000)]
+    block = "".join(lines)
+    with open(path, "w") as f:
+        for i in range(size * (1 << 20) / len(block) + 1):
+            f.write(block)
+
+def countLines(split):
+    count = 0
+    for line in readSplit(split):
+        count += 1
+    return count
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    directory = args['--dir']
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, "input.txt")
+    writeInput(path, int(args['--size']))
+    size = os.path.getsize(path)
+
+    start = time.time()
+    with open(path) as f:
+        lines = sum(1 for line in f)
+    elapsed = time.time() - start
+    print "{0:>10} {1:>8} {2:>12} {3:>10} {4:>10}".format(
+        "split MB", "splits", "split ms", "read s", "MB/s")
+    print "{0:>10} {1:>8} {2:>12} {3:>10.2f} {4:>10.1f}".format(
+        "file", 1, "", elapsed, size / elapsed / 1e6)
+
+    pool = Pool(int(args['--procs']))
+    for splitSize in [float(s) for s in args['--splits'].split(",")]:
+        start = time.time()
+        splits = getSplits([path], int(splitSize * (1 << 20)))
+        splitTime = time.time() - start
+        start = time.time()
+        counts = pool.map(countLines, splits)
+        elapsed = time.time() - start
+        assert sum(counts) == lines
+        print "{0:>10} {1:>8} {2:>12.3f} {3:>10.2f} {4:>10.1f}".format(
+            splitSize, len(splits), splitTime * 1000, elapsed, size / elapsed / 1e6)
+    pool.close()
+    pool.join()
+    shutil.rmtree(directory)
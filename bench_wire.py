@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""Wire format benchmark.
+
+Encodes and decodes the packets of one RPC (its message, the ack and the
+reply) as the session layer does, for the old format, where the RPC layer
+JSON-encodes (id, kind, payload) with a string id naming both locators and
+the session layer JSON-encodes that again with the sender's locator, and for
+the header of wire.py with each payload codec. Reports packets per second
+through an encode and a decode, and bytes on the wire per RPC. Then cuts
+payloads of each given size into fragments and reassembles them, reporting
+the rate.
+
+Usage:
+    bench_wire.py [-n <rpcs>] [-k <sizes>]
+
+Options:
+  -h --help                 Show this screen.
+  -n --rpcs=<rpcs>          RPCs encoded and decoded per format [default: 20000].
+  -k --sizes=<sizes>        Comma separated payload sizes in KB [default: 16,256,4096].
+"""
+from docopt import docopt
+from functions import mapWork
+from wire import (CODECS, Encoder, Reassembly, decode, decodeFragment,
+                  decodeHeader, fragments)
+
+import json
+import time
+
+SENDER = ("127.0.0.1", 8100, 4242)
+RECEIVER = ("127.0.0.1", 8101, 1717)
+
+# The packets of one LAUNCH of a map and one simulated LAUNCH, as
+# (kind, payload).
+WORK = mapWork(17, "wordcount", ["/data/input/part-00017.txt", 1 << 26, 1 << 26, 0], 4)
+RPCS = {
+    "map": [("msg", ("LAUNCH", (WORK, 1))), ("ack", None),
+            ("reply", [160000, 1 << 26, 2.5])],
+    "simulated": [("msg", ("LAUNCH", (17, 1))), ("ack", None),
+                  ("reply", ["LAUNCH", [17, 1]])],
+}
+
+def oldEncode(counter, kind, payload):
+    rpcId = "{0}:{1}:{2}".format(SENDER, RECEIVER, counter)
+    return json.dumps((SENDER, json.dumps((rpcId, kind, payload))))
+
+def oldDecode(packet):
+    locator, data = json.loads(packet)
+    rpcId, kind, payload = json.loads(data)
+    return tuple(locator), kind, rpcId, payload
+
+def measureOld(packets, rpcs):
+    start = time.time()
+    size = 0
+    for counter in xrange(rpcs):
+        for kind, payload in packets:
+            packet = oldEncode(counter, kind, payload)
+            oldDecode(packet)
+            size += len(packet)
+    return time.time() - start, size
+
+def measureWire(packets, rpcs, codec):
+    encoder = Encoder(SENDER, codec)
+    start = time.time()
+    size = 0
+    for counter in xrange(1, rpcs + 1):
+        for kind, payload in packets:
+            packet = encoder.encode(kind, counter, payload)
+            decode(packet)
+            size += len(packet)
+    return time.time() - start, size
+
+def measureFragments(size, runs):
+    encoder = Encoder(SENDER)
+    payload = "x" * size
+    start = time.time()
+    for run in xrange(runs):
+        body = encoder.body(payload)
+        reassembly = None
+        for index in range(fragments(body)):
+            packet = encoder.fragment("msg", run + 1, body, index)
+            locator, kind, code, rpcId, seq, ack, epoch, echo = decodeHeader(packet)
+            kind, index, count, length, data = decodeFragment(packet)
+            if reassembly == None:
+                reassembly = Reassembly(code, count, length)
+            reassembly.add(index, data)
+        assert reassembly.payload() == payload
+    return time.time() - start, fragments(encoder.body(payload))
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    rpcs = int(args['--rpcs'])
+    print "{0:>10} {1:>10} {2:>12} {3:>10}".format(
+        "rpc", "format", "packets/s", "bytes/rpc")
+    for name in sorted(RPCS):
+        packets = RPCS[name]
+        results = [("old", measureOld(packets, rpcs))]
+        for codec in sorted(CODECS):
+            results.append((codec, measureWire(packets, rpcs, codec)))
+        for fmt, (elapsed, size) in results:
+            print "{0:>10} {1:>10} {2:>12.0f} {3:>10.1f}".format(
+                name, fmt, rpcs * len(packets) / elapsed, float(size) / rpcs)
+    print
+    print "{0:>10} {1:>10} {2:>12} {3:>10}".format(
+        "KB", "fragments", "payloads/s", "MB/s")
+    for size in [int(k) * 1024 for k in args['--sizes'].split(",")]:
+        runs = max(1, (64 << 20) / size)
+        elapsed, count = measureFragments(size, runs)
+        print "{0:>10} {1:>10} {2:>12.0f} {3:>10.1f}".format(
+            size / 1024, count, runs / elapsed, runs * size / elapsed / 1e6)
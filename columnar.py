@@ -0,0 +1,446 @@
+from job import Job, SLOWSTART, MAX_ATTEMPTS
+from rpc import RPC
+
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Task and TaskAttempt status codes; the names match the object version.
+RUNNING = 0
+SUCCEEDED = 1
+KILLED_OR_FAILED = 2
+FAILED = 2
+TASK_STATUS = ("RUNNING", "SUCCEEDED", "KILLED_OR_FAILED")
+ATTEMPT_STATUS = ("RUNNING", "SUCCEEDED", "FAILED")
+
+# RPC state codes, as seen by the TaskAttempt rules.
+NO_RPC = 0
+RPC_PENDING = 1
+RPC_COMPLETE = 2
+RPC_REPLY_FAILED = 3
+
+def rpcState(rpc):
+    if rpc == None:
+        return NO_RPC
+    if rpc.status != "complete":
+        return RPC_PENDING
+    if rpc.reply == "failed":
+        return RPC_REPLY_FAILED
+    return RPC_COMPLETE
+
+def grow(array, size, fill):
+    grown = numpy.empty(size, dtype=array.dtype)
+    grown[:len(array)] = array
+    grown[len(array):] = fill
+    return grown
+
+class AttemptRef(object):
+    """Stands in for a TaskAttempt object in events and RPC wakeups."""
+    __slots__ = ("job", "index")
+
+    def __init__(self, job, index):
+        self.job = job
+        self.index = int(index)
+
+    @property
+    def work(self):
+        return self.job.taskWork[self.job.attemptTask[self.index]]
+
+    @property
+    def speculative(self):
+        return bool(self.job.attemptSpeculative[self.index])
+
+    # Worker of the task's other attempt, which a speculative attempt must
+    # not share (see TaskAttempt.avoid).
+    @property
+    def avoid(self):
+        job = self.job
+        if not job.attemptSpeculative[self.index]:
+            return None
+        m = job.numAttempts
+        others = numpy.flatnonzero((job.attemptTask[:m] == job.attemptTask[self.index]) &
+                                   (job.attemptStatus[:m] == RUNNING) &
+                                   (job.attemptContainer[:m] != -1))
+        if len(others) == 0:
+            return None
+        return job.locator(job.attemptContainer[others[0]])[0]
+
+    @property
+    def stage(self):
+        if self.job.attemptTask[self.index] < len(self.job.workList):
+            return "MAP"
+        return "REDUCE"
+
+    def rpcDone(self, rpc):
+        self.job.rpcChanged(self.index)
+
+    def kill(self):
+        self.job.killAttempts(numpy.array([self.index]))
+
+    def __eq__(self, other):
+        return (isinstance(other, AttemptRef) and
+                self.job is other.job and self.index == other.index)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.job), self.index))
+
+    def __str__(self):
+        container = self.job.attemptContainer[self.index]
+        return "<{0}: {1} {2}>".format(
+            self.work, ATTEMPT_STATUS[self.job.attemptStatus[self.index]],
+            self.job.locator(container))
+
+class ColumnarJob(Job):
+    """Job that keeps Task and TaskAttempt state in NumPy columns.
+
+    The Job rules are inherited unchanged. The Task and TaskAttempt rules are
+    the same as in job.py, but each is evaluated as one mask over every task
+    or attempt in the job, so a pass costs a handful of array operations
+    rather than an applyRules() call per object. Containers are stored as
+    indexes into self.containers and RPC statuses as rpcState() codes.
+    """
+    def __init__(self, workList, pool, rpcManager, eventQueue, speculator=None,
+                 reduceList=(), slowstart=SLOWSTART):
+        if numpy == None:
+            raise ImportError("ColumnarJob requires numpy")
+        self.tasksCreated = False
+        # work of every task; the maps, then the reduces once created
+        self.taskWork = workList
+        self.containers = []
+        self.containerIds = {}
+        self.numAttempts = 0
+        self.attemptTask = numpy.zeros(0, dtype=numpy.int32)
+        self.attemptStatus = numpy.zeros(0, dtype=numpy.int8)
+        self.attemptContainer = numpy.zeros(0, dtype=numpy.int32)
+        self.attemptRequested = numpy.zeros(0, dtype=numpy.bool_)
+        self.attemptSpeculative = numpy.zeros(0, dtype=numpy.bool_)
+        self.launchState = numpy.zeros(0, dtype=numpy.int8)
+        self.commitState = numpy.zeros(0, dtype=numpy.int8)
+        self.cleanupState = numpy.zeros(0, dtype=numpy.int8)
+        self.attemptTime = numpy.zeros(0, dtype=numpy.float64)
+        self.launchRPC = []
+        self.commitRPC = []
+        self.cleanupRPC = []
+        Job.__init__(self, workList, pool, rpcManager, eventQueue, speculator,
+                     reduceList, slowstart)
+        self.pool.subscribe(self, "TA_ASSIGNED")
+        self.pool.subscribe(self, "TA_KILL")
+
+    def applyRules(self):
+        Job.applyRules(self)
+        if self.tasksCreated and self.status == "RUNNING":
+            fired = self.applyTaskRules()
+            fired += self.applyAttemptRules()
+            if fired > 0:
+                self.pool.wake(self)
+
+    def applyTaskRules(self):
+        n = len(self.taskWork)
+        m = self.numAttempts
+        running = (self.taskStatus == RUNNING)
+        killed = running & self.taskKilled
+        attemptTask = self.attemptTask[:m]
+        attemptStatus = self.attemptStatus[:m]
+
+        # Rule 1: Task killed and all TaskAttempts have stopped; goal reached.
+        stopped = numpy.flatnonzero(killed & (self.taskRunningAttempts == 0))
+        # Rule 5: Task completed; goal reached.
+        done = numpy.flatnonzero(running & ~killed & (self.taskCommit != -1))
+        # Rule 3: Attempts keep failing; fail.
+        failing = (running & ~killed & (self.taskCommit == -1) &
+                   (self.taskFailures >= MAX_ATTEMPTS))
+        failed = numpy.flatnonzero(failing)
+        for i in failed.tolist():
+            print "Task failed after {0} attempts: {1}".format(self.taskFailures[i], self.taskWork[i])
+        self.taskKilled[failed] = True
+        self.killAttempts(numpy.flatnonzero(failing[attemptTask] & (attemptStatus == RUNNING)))
+        # Rule 4: Task not complete last iteration; check and add attempt if needed.
+        checking = running & ~killed & ~failing & (self.taskCommit == -1)
+        succeeded = numpy.flatnonzero(checking[attemptTask] &
+                                      (attemptStatus == SUCCEEDED))
+        self.taskCommit[attemptTask[succeeded]] = self.attemptContainer[succeeded]
+        losers = numpy.flatnonzero(checking[attemptTask] &
+                                   (attemptStatus == RUNNING) &
+                                   (self.taskCommit[attemptTask] != -1))
+        self.killAttempts(losers)
+        live = numpy.bincount(attemptTask[attemptStatus != FAILED], minlength=n)
+        added = numpy.flatnonzero(checking & (self.taskCommit == -1) & (live == 0))
+        self.addAttempts(added)
+
+        self.setTaskStatus(stopped, KILLED_OR_FAILED)
+        self.setTaskStatus(done, SUCCEEDED)
+        return len(stopped) + len(done) + len(failed) + len(succeeded) + len(added)
+
+    def applyAttemptRules(self):
+        m = self.numAttempts
+        container = self.attemptContainer[:m]
+        cleanup = self.cleanupState[:m]
+        launch = self.launchState[:m]
+        commit = self.commitState[:m]
+        running = (self.attemptStatus[:m] == RUNNING)
+        hasContainer = running & (container != -1)
+        cleaning = hasContainer & (cleanup != NO_RPC)
+        working = hasContainer & (cleanup == NO_RPC)
+        launched = working & (launch == RPC_COMPLETE)
+
+        # Rule 1: No container allocated; request container.
+        request = numpy.flatnonzero(running & (container == -1) &
+                                    ~self.attemptRequested[:m])
+        # Rule 2: Cleanup RPC failed; retry.
+        retry = numpy.flatnonzero(cleaning & (cleanup == RPC_REPLY_FAILED))
+        # Rule 3: Cleanup RPC completed; release container, goal reached.
+        cleaned = numpy.flatnonzero(cleaning & (cleanup == RPC_COMPLETE))
+        # Rule 4: Attempt not launched; launch.
+        start = numpy.flatnonzero(working & (launch == NO_RPC))
+        # Rule 5: Attempt failed; report container failure, goal reached.
+        launchFailed = numpy.flatnonzero(working & (launch == RPC_REPLY_FAILED))
+        # Rule 6: Attempt complete but not committed; request commit, or
+        # if another attempt of the task got to commit first, kill it.
+        finished = numpy.flatnonzero(launched & (commit == NO_RPC))
+        toCommit = self.grantCommits(finished)
+        # Rule 7: Commit failed; report container failure, goal reached.
+        commitFailed = numpy.flatnonzero(launched & (commit == RPC_REPLY_FAILED))
+        # Rule 8: Commit succeeded; release container, goal reached.
+        committed = numpy.flatnonzero(launched & (commit == RPC_COMPLETE))
+
+        for i in request.tolist():
+            self.eventQueue.append(("CONTAINER_REQ", (AttemptRef(self, i), None)))
+        self.attemptRequested[request] = True
+        for i in retry.tolist():
+            self.sendRPC(i, "CONTAINER_REMOTE_CLEANUP")
+        now = time.time()
+        for i in start.tolist():
+            self.sendRPC(i, "LAUNCH")
+        self.attemptTime[start] = now
+        self.killAttempts(finished[~numpy.in1d(finished, toCommit)])
+        for i in toCommit.tolist():
+            self.sendRPC(i, "COMMIT")
+        for runtime in (now - self.attemptTime[toCommit]).tolist():
+            self.attemptFinished(runtime)
+        for i in cleaned.tolist():
+            self.eventQueue.append(("CONTAINER_DEALLOCATE", (AttemptRef(self, i), self.locator(container[i]))))
+        for i in numpy.concatenate((launchFailed, commitFailed)).tolist():
+            self.eventQueue.append(("CONTAINER_FAILED", (AttemptRef(self, i), self.locator(container[i]))))
+        for i in committed.tolist():
+            self.eventQueue.append(("CONTAINER_DEALLOCATE", (AttemptRef(self, i), self.locator(container[i]))))
+        self.setAttemptStatus(numpy.concatenate((cleaned, launchFailed, commitFailed)), FAILED)
+        numpy.add.at(self.taskFailures, self.attemptTask[launchFailed], 1)
+        numpy.add.at(self.taskFailures, self.attemptTask[commitFailed], 1)
+        self.setAttemptStatus(committed, SUCCEEDED)
+        return (len(request) + len(retry) + len(cleaned) + len(start) +
+                len(launchFailed) + len(finished) + len(commitFailed) +
+                len(committed))
+
+    def handleEvents(self, newEvents):
+        jobEvents = []
+        for eventType, value in newEvents:
+            if eventType == "TA_ASSIGNED":
+                attempt, container = value
+                if attempt.job is self:
+                    self.assignContainer(attempt.index, container)
+            elif eventType == "TA_KILL":
+                attempt, container = value
+                if attempt.job is self:
+                    attempt.kill()
+            else:
+                jobEvents.append((eventType, value))
+        Job.handleEvents(self, jobEvents)
+
+    # Number of map tasks created.
+    def numTasks(self):
+        if self.tasksCreated:
+            return len(self.workList)
+        return 0
+
+    def createTasks(self):
+        n = len(self.workList)
+        self.taskStatus = numpy.zeros(n, dtype=numpy.int8)
+        self.taskKilled = numpy.zeros(n, dtype=numpy.bool_)
+        self.taskCommit = numpy.full(n, -1, dtype=numpy.int32)
+        self.taskRunningAttempts = numpy.zeros(n, dtype=numpy.int32)
+        self.taskFailures = numpy.zeros(n, dtype=numpy.int32)
+        self.taskCommitter = numpy.full(n, -1, dtype=numpy.int32)
+        self.taskSpeculations = numpy.zeros(n, dtype=numpy.int32)
+        self.taskCounts["RUNNING"] = n
+        self.tasksCreated = True
+
+    def createReduceTasks(self):
+        self.taskWork = list(self.workList) + list(self.reduceList)
+        size = len(self.taskWork)
+        self.taskStatus = grow(self.taskStatus, size, RUNNING)
+        self.taskKilled = grow(self.taskKilled, size, self.killed)
+        self.taskCommit = grow(self.taskCommit, size, -1)
+        self.taskRunningAttempts = grow(self.taskRunningAttempts, size, 0)
+        self.taskFailures = grow(self.taskFailures, size, 0)
+        self.taskCommitter = grow(self.taskCommitter, size, -1)
+        self.taskSpeculations = grow(self.taskSpeculations, size, 0)
+        self.taskCounts["RUNNING"] += len(self.reduceList)
+
+    def mapsCompleted(self):
+        if not self.tasksCreated:
+            return 0
+        return int(numpy.count_nonzero(self.taskStatus[:len(self.workList)] == SUCCEEDED))
+
+    def killTasks(self):
+        self.taskKilled[:] = True
+        m = self.numAttempts
+        self.killAttempts(numpy.flatnonzero(self.attemptStatus[:m] == RUNNING))
+
+    def nodeCrash(self, locator):
+        if not self.tasksCreated:
+            return
+        cids = [cid for cid, container in enumerate(self.containers)
+                if container[0] == locator]
+        lost = numpy.flatnonzero(numpy.in1d(self.taskCommit, cids) &
+                                 (self.taskStatus != KILLED_OR_FAILED))
+        self.taskCommit[lost] = -1
+        self.setTaskStatus(lost, RUNNING)
+        m = self.numAttempts
+        self.setAttemptStatus(numpy.flatnonzero(numpy.in1d(self.attemptContainer[:m], cids)), FAILED)
+
+    def speculate(self, now):
+        m = self.numAttempts
+        attemptTask = self.attemptTask[:m]
+        working = ((self.attemptStatus[:m] == RUNNING) &
+                   (self.launchState[:m] == RPC_PENDING) &
+                   (self.cleanupState[:m] == NO_RPC))
+        eligible = ((self.taskStatus == RUNNING) & ~self.taskKilled &
+                    (self.taskRunningAttempts == 1) &
+                    (self.taskSpeculations < self.speculator.maxPerTask))
+        speculating = int(numpy.count_nonzero(self.taskRunningAttempts > 1))
+        # attempts that were never launched have a NaN attemptTime
+        with numpy.errstate(invalid="ignore"):
+            late = now - self.attemptTime[:m] > self.speculator.threshold()
+        slow = numpy.flatnonzero(working & eligible[attemptTask] & late)
+        slow = slow[numpy.argsort(self.attemptTime[slow], kind="mergesort")]
+        tasks = attemptTask[slow[:self.speculator.allowed(len(self.taskWork), speculating)]]
+        for i in tasks.tolist():
+            print "Speculating: " + str(self.taskWork[i])
+        self.addAttempts(tasks, True)
+        self.taskSpeculations[tasks] += 1
+        self.speculator.launched += len(tasks)
+        if len(tasks) > 0:
+            self.pool.wake(self)
+
+    def addAttempts(self, tasks, speculative=False):
+        k = len(tasks)
+        if k == 0:
+            return
+        first = self.numAttempts
+        if first + k > len(self.attemptTask):
+            size = max(first + k, 2 * len(self.attemptTask))
+            self.attemptTask = grow(self.attemptTask, size, 0)
+            self.attemptStatus = grow(self.attemptStatus, size, RUNNING)
+            self.attemptContainer = grow(self.attemptContainer, size, -1)
+            self.attemptRequested = grow(self.attemptRequested, size, False)
+            self.attemptSpeculative = grow(self.attemptSpeculative, size, False)
+            self.launchState = grow(self.launchState, size, NO_RPC)
+            self.commitState = grow(self.commitState, size, NO_RPC)
+            self.cleanupState = grow(self.cleanupState, size, NO_RPC)
+            self.attemptTime = grow(self.attemptTime, size, numpy.nan)
+        self.attemptTask[first:first + k] = tasks
+        self.attemptSpeculative[first:first + k] = speculative
+        self.numAttempts += k
+        self.launchRPC += [None] * k
+        self.commitRPC += [None] * k
+        self.cleanupRPC += [None] * k
+        self.taskRunningAttempts[tasks] += 1
+
+    # The finished attempts allowed to commit: the first of each task, as
+    # long as no other attempt of it holds the commit and has not failed
+    # (see Task.canCommit).
+    def grantCommits(self, attempts):
+        tasks = self.attemptTask[attempts]
+        holder = self.taskCommitter[tasks]
+        free = (holder == -1) | (self.attemptStatus[holder] == FAILED)
+        tasks, first = numpy.unique(tasks[free], return_index=True)
+        granted = attempts[free][first]
+        self.taskCommitter[tasks] = granted
+        return granted
+
+    def killAttempts(self, attempts):
+        attempts = attempts[(self.attemptStatus[attempts] == RUNNING) &
+                            (self.cleanupState[attempts] == NO_RPC)]
+        unassigned = attempts[self.attemptContainer[attempts] == -1]
+        for i in attempts[self.attemptContainer[attempts] != -1]:
+            self.sendRPC(i, "CONTAINER_REMOTE_CLEANUP")
+        # Nothing runs yet; withdraw the container requests.
+        for i in unassigned[self.attemptRequested[unassigned]].tolist():
+            self.eventQueue.append(("CONTAINER_DEALLOCATE", (AttemptRef(self, i), None)))
+        self.setAttemptStatus(unassigned, FAILED)
+        if len(unassigned) > 0:
+            self.pool.wake(self)
+
+    def assignContainer(self, i, locator):
+        if self.attemptStatus[i] != RUNNING:
+            # killed while it waited for the container; hand it back
+            self.eventQueue.append(("CONTAINER_DEALLOCATE", (AttemptRef(self, i), locator)))
+        elif self.attemptContainer[i] == -1:
+            print "Container Assigned: " + str(locator) + " to " + str(self.taskWork[self.attemptTask[i]])
+            if locator not in self.containerIds:
+                self.containerIds[locator] = len(self.containers)
+                self.containers.append(locator)
+            self.attemptContainer[i] = self.containerIds[locator]
+            self.pool.wake(self)
+
+    def locator(self, container):
+        container = int(container)
+        if container == -1:
+            return None
+        return self.containers[container]
+
+    # Send an RPC to the attempt's container, a (worker locator, slot) pair;
+    # once it completes or fails, rpcChanged() copies its outcome into the
+    # matching state column.
+    def sendRPC(self, i, rpcType):
+        locator, slot = self.locator(self.attemptContainer[i])
+        rpc = RPC(locator, None,
+                  (rpcType, (self.taskWork[self.attemptTask[i]], slot)))
+        if rpcType == "LAUNCH":
+            self.launchRPC[i] = rpc
+        elif rpcType == "COMMIT":
+            self.commitRPC[i] = rpc
+        else:
+            self.cleanupRPC[i] = rpc
+        self.rpcManager.send(rpc)
+        self.rpcChanged(i)
+        rpc.addCallback(AttemptRef(self, i).rpcDone)
+
+    def rpcChanged(self, i):
+        self.launchState[i] = rpcState(self.launchRPC[i])
+        self.commitState[i] = rpcState(self.commitRPC[i])
+        self.cleanupState[i] = rpcState(self.cleanupRPC[i])
+        self.pool.wake(self)
+
+    def setTaskStatus(self, tasks, status):
+        if len(tasks) == 0:
+            return
+        old = numpy.bincount(self.taskStatus[tasks], minlength=len(TASK_STATUS))
+        for code, name in enumerate(TASK_STATUS):
+            self.taskCounts[name] -= int(old[code])
+        self.taskCounts[TASK_STATUS[status]] += len(tasks)
+        self.taskStatus[tasks] = status
+        if status == SUCCEEDED:
+            for i in tasks[tasks < len(self.workList)].tolist():
+                self.mapEvents.append([self.taskWork[i], self.locator(self.taskCommit[i])])
+
+    def setAttemptStatus(self, attempts, status):
+        if len(attempts) == 0:
+            return
+        wasRunning = attempts[self.attemptStatus[attempts] == RUNNING]
+        numpy.subtract.at(self.taskRunningAttempts, self.attemptTask[wasRunning], 1)
+        self.attemptStatus[attempts] = status
+
+    def __str__(self):
+        s = ""
+        for i in range(len(self.taskWork) if self.tasksCreated else 0):
+            s = s + "<{0}: {1} {2}>".format(self.taskWork[i],
+                                            TASK_STATUS[self.taskStatus[i]],
+                                            self.locator(self.taskCommit[i])) + "\n"
+        return s
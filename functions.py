@@ -0,0 +1,172 @@
+"""Map and reduce functions that a Job can name in its work, and the work
+item formats.
+
+A map-job work item is [taskId, mapName, split, numReduces, combineName],
+where split is a byte range of an input file (see inputformat.py). Workers
+look the map function up here by name, since functions cannot travel in the
+JSON of an RPC. A map function takes one record of the split, a line of text
+without its newline or a fixed-size record, and returns (key, value) pairs;
+keys must be strings, which may hold any bytes, or numbers. The pairs are
+split into numReduces partitions by partition(), sorted by key within each
+and written to one file with an index of the [offset, length] of every
+partition (see runMap). combineName, if not None, names a reduce
+function that is applied to the map's own values of each key first.
+
+A reduce work item is ["reduce", partition, numMaps, reduceName]; the reducer
+polls the master for completed maps until it has heard of all numMaps of
+them, fetching its partition of each, and then calls the reduce function
+with every key and the list of its values, in key order. A reduceName of
+None simulates the reduce.
+"""
+from inputformat import readSplit
+from spill import MapOutputBuffer, MERGE_FACTOR, readRun
+
+from heapq import merge
+from itertools import groupby
+import json
+import marshal
+import os
+import time
+import traceback
+import zlib
+
+MAPS = {}
+REDUCES = {}
+# Bytes of output a map buffers before it spills, unless the worker says.
+SPILL_LIMIT = 100 << 20
+
+def register(name, table=MAPS):
+    def add(function):
+        table[name] = function
+        return function
+    return add
+
+@register("wordcount")
+def wordcount(line):
+    return [(word, 1) for word in line.split()]
+
+@register("linelength")
+def linelength(line):
+    return [(len(line), 1)]
+
+@register("identity")
+def identity(line):
+    return [(line, None)]
+
+@register("sum", REDUCES)
+def total(key, values):
+    return sum(values)
+
+@register("count", REDUCES)
+def count(key, values):
+    return len(values)
+
+@register("identity", REDUCES)
+def values(key, values):
+    return values
+
+def mapWork(taskId, mapName, split, numReduces, combineName=None):
+    return [taskId, mapName, split, numReduces, combineName]
+
+def isMapWork(work):
+    return isinstance(work, (list, tuple)) and len(work) == 5 and work[0] != "reduce"
+
+def reduceWork(partition, numMaps, reduceName=None):
+    return ["reduce", partition, numMaps, reduceName]
+
+def isReduceWork(work):
+    return isinstance(work, (list, tuple)) and len(work) == 4 and work[0] == "reduce"
+
+# Work that runs a real function rather than being simulated.
+def isRealWork(work):
+    return isMapWork(work) or (isReduceWork(work) and work[3] != None)
+
+# Hash the key's bytes, so keys that are not valid text still partition.
+def partition(key, numReduces):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    elif not isinstance(key, str):
+        key = str(key)
+    return (zlib.crc32(key) & 0xffffffff) % numReduces
+
+def indexPath(outputPath):
+    return outputPath + ".index"
+
+# Run work's map function over the records of its split, writing one
+# marshalled (key, value) pair per record to outputPath, partition after
+# partition, and the [offset, length] of each partition to
+# indexPath(outputPath). At most limit bytes of output are held in memory
+# (see spill.py). Runs in a worker's process pool; any error is reported as
+# "failed" rather than raised so the worker always hears back.
+def runMap(work, outputPath, limit=SPILL_LIMIT):
+    buf = None
+    try:
+        taskId, mapName, split, numReduces, combineName = work
+        function = MAPS[mapName]
+        combiner = None
+        if combineName != None:
+            combiner = REDUCES[combineName]
+        numReduces = max(1, numReduces)
+        start = time.time()
+        records = 0
+        buf = MapOutputBuffer(outputPath, indexPath(outputPath), numReduces,
+                              limit, combiner)
+        for record in readSplit(split):
+            for key, value in function(record):
+                buf.collect(partition(key, numReduces), key, value)
+                records += 1
+        buf.close()
+        return [records, split[2], time.time() - start]
+    except Exception:
+        traceback.print_exc()
+        if buf != None:
+            buf.discard()
+        return "failed"
+
+# Merge the fetched segments, each sorted by key, and write one
+# [key, reduce(key, values)] line per key, in key order, to outputPath; only
+# one key's values are in memory at a time. Like the map side, at most
+# MERGE_FACTOR segments are open at once: more are first merged into fewer,
+# larger ones next to outputPath.
+def runReduce(work, segments, outputPath):
+    merged = []
+    try:
+        tag, reducePartition, numMaps, reduceName = work
+        function = REDUCES[reduceName]
+        start = time.time()
+        keys = 0
+        inputBytes = sum(os.path.getsize(segment) for segment in segments)
+        segments = list(segments)
+        while len(segments) > MERGE_FACTOR:
+            runs = segments[:MERGE_FACTOR]
+            path = "{0}.merge{1}".format(outputPath, len(merged))
+            with open(path, "wb") as run:
+                for record in merge(*[readRun(segment) for segment in runs]):
+                    marshal.dump(record, run)
+            merged.append(path)
+            segments = segments[MERGE_FACTOR:] + [path]
+            for segment in runs:
+                if segment in merged:
+                    os.remove(segment)
+        with open(outputPath, "w") as outputFile:
+            records = merge(*[readRun(segment) for segment in segments])
+            for key, group in groupby(records, lambda record: record[0]):
+                values = [value for key, value in group]
+                outputFile.write(outputLine(key, function(key, values)))
+                keys += 1
+        return [keys, inputBytes, time.time() - start]
+    except Exception:
+        traceback.print_exc()
+        return "failed"
+    finally:
+        for path in merged:
+            if os.path.exists(path):
+                os.remove(path)
+
+# A JSON [key, value] line of reduce output; keys that are not UTF-8, such as
+# binary records, are read as latin-1 so that every byte is kept.
+def outputLine(key, value):
+    try:
+        return json.dumps([key, value]) + "\n"
+    except UnicodeDecodeError:
+        return json.dumps([key, value], encoding="latin-1") + "\n"
@@ -0,0 +1,74 @@
+"""Splits of a map job's input files and the records in them.
+
+A split is [path, start, length, recordSize]: the byte range [start, start +
+length) of a local file. recordSize 0 means the file is newline-delimited
+text; otherwise it holds fixed-size records of recordSize bytes. The master
+makes splits from file sizes alone (getSplits); each map reads its split
+through an mmap of the file (readSplit).
+
+A text split starts at the first line that begins inside it and ends with
+the last line that begins inside it, read to its newline even if that lies
+past the split, so every line is read by exactly one split. Fixed-size
+record splits are cut at record boundaries.
+"""
+from itertools import chain
+import mmap
+import os
+
+# Bytes per split unless the master says.
+SPLIT_SIZE = 64 << 20
+# Bytes of text split into lines at once.
+BLOCK = 1 << 20
+
+def getSplits(paths, splitSize=SPLIT_SIZE, recordSize=0):
+    if recordSize > 0:
+        splitSize = max(1, splitSize / recordSize) * recordSize
+    splits = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if recordSize > 0:
+            # a trailing partial record is not a record
+            size -= size % recordSize
+        for start in range(0, size, splitSize):
+            splits.append([path, start, min(splitSize, size - start), recordSize])
+    return splits
+
+# The split covering all of path.
+def wholeFile(path, recordSize=0):
+    size = os.path.getsize(path)
+    if recordSize > 0:
+        size -= size % recordSize
+    return [path, 0, size, recordSize]
+
+# An iterator over the records of split, without their newlines for text.
+# The mmap is unmapped once the iterator is dropped.
+def readSplit(split):
+    path, start, length, recordSize = split
+    if length == 0:
+        return iter(())
+    if isinstance(path, unicode):
+        # paths arrive as JSON text; the master only sends UTF-8 ones
+        path = path.encode("utf-8")
+    with open(path, "rb") as inputFile:
+        data = mmap.mmap(inputFile.fileno(), 0, access=mmap.ACCESS_READ)
+    if recordSize > 0:
+        return (data[pos:pos + recordSize]
+                for pos in xrange(start, start + length, recordSize))
+    return chain.from_iterable(readBlocks(data, start, start + length))
+
+# Yield the lines that begin in [start, end) as lists, a block at a time.
+def readBlocks(data, start, end):
+    pos = start
+    if start > 0:
+        # the line holding byte start - 1 belongs to the previous split
+        pos = data.find("\n", start - 1) + 1
+        if pos == 0:
+            return
+    size = len(data)
+    while pos < end and pos < size:
+        # cut the block after the line holding its last byte
+        stop = data.find("\n", min(end, pos + BLOCK) - 1)
+        if stop < 0:
+            stop = size
+        yield data[pos:stop].split("\n")
+        pos = stop + 1
@@ -3,8 +3,29 @@ from rpc import RPC
 import time
 from collections import deque
 
+# Fraction of the map tasks that must have succeeded before the reduce tasks
+# are scheduled (Hadoop's reduce slowstart).
+SLOWSTART = 0.05
+# Map events sent in one MAP_EVENTS reply.
+MAP_EVENTS_PER_REPLY = 1000
+# Attempts of a task that may fail before the task, and with it the job,
+# fails (Hadoop's maxattempts); killed attempts do not count.
+MAX_ATTEMPTS = 4
+
 class Job(object):
-    def __init__(self, workList, pool, rpcManager, eventQueue):
+    eventTypes = frozenset(("JOB_SETUP_COMPLETED", "JOB_SETUP_FAILED",
+                            "JOB_COMMIT_COMPLETED", "JOB_COMMIT_FAILED",
+                            "JOB_KILL", "JOB_ABORT_COMPLETED",
+                            "JOB_UPDATED_NODES", "JOB_DIAGNOSTIC_UPDATE"))
+    __slots__ = ("status", "setup", "setup_request_sent", "setup_abort_sent",
+                 "tasks_complete", "committed", "killed", "workList",
+                 "reduceList", "slowstart", "reduces_created", "mapsDone",
+                 "mapEvents", "taskList", "taskCounts", "pool", "rpcManager",
+                 "eventQueue", "eventsIn", "parent", "speculator",
+                 "speculateTimer")
+
+    def __init__(self, workList, pool, rpcManager, eventQueue, speculator=None,
+                 reduceList=(), slowstart=SLOWSTART):
         self.status = "RUNNING"
         self.setup = False
         self.setup_request_sent = False
@@ -13,11 +34,28 @@ class Job(object):
         self.committed = False
         self.killed = False
         self.workList = workList
+        # work of the reduce tasks, scheduled once slowstart of the maps are done
+        self.reduceList = reduceList
+        self.slowstart = slowstart
+        self.reduces_created = False
+        self.mapsDone = 0
+        # [work, container] of every map that succeeded, oldest first; served
+        # to the reducers by serveMapEvents()
+        self.mapEvents = []
         self.taskList = []
+        self.taskCounts = {"RUNNING": 0, "SUCCEEDED": 0, "KILLED_OR_FAILED": 0}
         self.pool = pool
         self.rpcManager = rpcManager
         self.eventQueue = eventQueue
-        self.eventsIn = deque()
+        # only created if events are pushed to the Job directly
+        self.eventsIn = None
+        self.parent = None
+        # speculation policy; None disables speculative attempts
+        self.speculator = speculator
+        self.speculateTimer = None
+        # node updates and job kills do not name a job; receive them all
+        self.pool.subscribe(self, "JOB_UPDATED_NODES")
+        self.pool.subscribe(self, "JOB_KILL")
         # schedule itself to run
         self.pool.activate(self)
     
@@ -28,12 +66,14 @@ class Job(object):
         elif self.killed:
             if not self.all_task_done_or_failed():
                 # Rule 1: Job was killed but tasks have not died yet; kill all tasks.
-                for task in self.taskList:
-                    task.kill()
+                self.killTasks()
+                self.pool.sleep(self)
             elif self.setup:
                 # Rule 2: Job was killed after setup occured; 
                 if not self.setup_abort_sent:
                     self.eventQueue.append(("JOB_ABORT", self))
+                    self.setup_abort_sent = True
+                self.pool.sleep(self)
             else:
                 # Rule 3: Job kill is complete; goal reached.
                 self.status = "FAILED"
@@ -41,34 +81,39 @@ class Job(object):
             # Rule 4: Job not yet setup; request the job be setup.
             if not self.setup_request_sent:
                 self.eventQueue.append(("JOB_SETUP", self))
-        elif len(self.workList) != len(self.taskList):
+                self.setup_request_sent = True
+            self.pool.sleep(self)
+        elif len(self.workList) != self.numTasks():
             # Rule 5: Tasks not yet created and scheudled; create and schedule tasks.
-            self.taskList = [Task(w, self.pool, self.rpcManager, self.eventQueue) for w in self.workList]
+            self.createTasks()
+        elif not self.reduces_created and self.mapsCompleted() >= self.slowstart * len(self.workList):
+            # Rule 6: Enough maps have completed; create and schedule reduce tasks.
+            self.createReduceTasks()
+            self.reduces_created = True
         elif not self.tasks_complete:
-            # Rule 6: Tasks not complete last iteration; check and commit if complete.
-            self.tasks_complete = True
-            for task in self.taskList:
-                if task.getStatus() == "KILLED_OR_FAILED":
-                    self.killed = True
-                    self.tasks_complete = False
-                    break
-                if task.getStatus() == "RUNNING":
-                    self.tasks_complete = False
-                    break
-            if self.tasks_complete:
+            # Rule 7: Tasks not complete last iteration; check and commit if complete.
+            if self.taskCounts["KILLED_OR_FAILED"] > 0:
+                self.killed = True
+            elif self.taskCounts["RUNNING"] == 0:
+                self.tasks_complete = True
                 self.eventQueue.append(("JOB_COMMIT", self))
+            else:
+                self.checkSpeculation()
+                self.pool.sleep(self)
         elif not self.committed:
             # Placeholder for state with nothing to do (Job not yet committed).
-            pass
+            self.pool.sleep(self)
         else:
-            # Rule 7: Job completed tasks and committed; goal reached;
+            # Rule 8: Job completed tasks and committed; goal reached;
             self.status = "SUCCEEDED"
     
     def handleEvents(self, newEvents):
-        self.eventsIn += newEvents
+        if self.eventsIn != None:
+            newEvents = list(self.eventsIn) + list(newEvents)
+            self.eventsIn = None
 
         # Turn events into state changes
-        for eventType, value in list(self.eventsIn):
+        for eventType, value in newEvents:
             # JobEventType Events
             if eventType == "JOB_SETUP_COMPLETED":
                 if self.status == "RUNNING" and not self.setup and value == self:
@@ -88,21 +133,104 @@ class Job(object):
                 if self.killed and value == self:
                     self.setup = False
             if eventType == "JOB_UPDATED_NODES":
-                for task in self.taskList:
-                    task.nodeCrash(value)
+                self.nodeCrash(value)
             if eventType == "JOB_DIAGNOSTIC_UPDATE":
                 # Do some update
                 pass
-        self.eventsIn.clear()
     
     def pushNewEvents(self, newEvents):
+        if self.eventsIn == None:
+            self.eventsIn = deque()
         self.eventsIn += newEvents
+        self.pool.wake(self)
         
-    def all_task_done_or_failed(self):
+    # Number of map tasks created.
+    def numTasks(self):
+        if self.reduces_created:
+            return len(self.taskList) - len(self.reduceList)
+        return len(self.taskList)
+
+    def createTasks(self):
+        self.taskList = [Task(w, self.pool, self.rpcManager, self.eventQueue, self) for w in self.workList]
+        self.taskCounts["RUNNING"] = len(self.taskList)
+
+    def createReduceTasks(self):
+        self.taskList += [Task(w, self.pool, self.rpcManager, self.eventQueue, self, "REDUCE") for w in self.reduceList]
+        self.taskCounts["RUNNING"] += len(self.reduceList)
+
+    def mapsCompleted(self):
+        return self.mapsDone
+
+    # Handler for the MAP_EVENTS RPC: a reducer asks for the map events from
+    # the index it has seen up to and gets the next few.
+    def serveMapEvents(self, rpc):
+        rpcType, start = rpc.msg
+        rpc.reply = self.mapEvents[start:start + MAP_EVENTS_PER_REPLY]
+        rpc.status = "send"
+
+    def killTasks(self):
         for task in self.taskList:
-            if task.getStatus() == "RUNNING":
-                return False
-        return True
+            task.kill()
+
+    def nodeCrash(self, locator):
+        for task in self.taskList:
+            task.nodeCrash(locator)
+
+    # Every speculator.interval seconds, while tasks run, start speculative
+    # attempts for the tasks whose only attempt is slow.
+    def checkSpeculation(self):
+        if self.speculator == None:
+            return
+        if self.speculateTimer != None and self.speculateTimer.queued:
+            return
+        if self.speculator.threshold() != None:
+            self.speculate(time.time())
+        self.speculateTimer = self.pool.wakeAfter(self, self.speculator.interval)
+
+    def speculate(self, now):
+        threshold = self.speculator.threshold()
+        slow = []
+        speculating = 0
+        for task in self.taskList:
+            if task.runningAttempts > 1:
+                speculating += 1
+            elif task.speculations < self.speculator.maxPerTask:
+                started = task.launchTime()
+                if started != None and now - started > threshold:
+                    slow.append((started, task))
+        slow.sort(key=lambda entry: entry[0])
+        for started, task in slow[:self.speculator.allowed(len(self.taskList), speculating)]:
+            print "Speculating: " + str(task.work)
+            task.addAttempt(True)
+            task.speculations += 1
+            self.speculator.launched += 1
+
+    # Runtime of an attempt that finished running; feeds the speculator.
+    def attemptFinished(self, runtime):
+        if self.speculator != None:
+            self.speculator.attemptFinished(runtime)
+
+    def all_task_done_or_failed(self):
+        return self.taskCounts["RUNNING"] == 0
+
+    # Keep taskCounts and the map events current; called by a Task whenever
+    # its status changes.
+    def taskStatusChanged(self, task, oldStatus, newStatus):
+        self.taskCounts[oldStatus] -= 1
+        self.taskCounts[newStatus] += 1
+        if task.stage == "MAP":
+            if oldStatus == "SUCCEEDED":
+                self.mapsDone -= 1
+            if newStatus == "SUCCEEDED":
+                self.mapsDone += 1
+                self.mapEvents.append([task.work, task.commitLocator])
+
+    # Fraction of tasks, maps and reduces, that have succeeded.
+    def progress(self):
+        total = len(self.workList) + len(self.reduceList)
+        if total == 0:
+            return 0.0
+        return self.taskCounts["SUCCEEDED"] / float(total)
     
     def getStatus(self):
         return self.status
@@ -114,17 +242,30 @@ class Job(object):
         return s
 
 class Task(object):
-    def __init__(self, work, pool, rpcManager, eventQueue):
+    eventTypes = frozenset()
+    __slots__ = ("status", "commitLocator", "killed", "work", "stage",
+                 "taskAttempts", "runningAttempts", "failedAttempts",
+                 "committer", "speculations", "time", "pool", "rpcManager",
+                 "eventQueue", "parent")
+
+    def __init__(self, work, pool, rpcManager, eventQueue, parent=None, stage="MAP"):
         self.status = "RUNNING"
         self.commitLocator = None
         self.killed = False
         self.work = work
+        # "MAP" or "REDUCE"; both stages run the same rules
+        self.stage = stage
         self.taskAttempts = []
+        self.runningAttempts = 0
+        self.failedAttempts = 0
+        # the attempt allowed to commit, see canCommit
+        self.committer = None
+        self.speculations = 0
         self.time = None
         self.pool = pool
         self.rpcManager = rpcManager
         self.eventQueue = eventQueue
-        self.eventsIn = deque()
+        self.parent = parent
         # schedule itself to run
         self.pool.activate(self)
     
@@ -135,44 +276,102 @@ class Task(object):
         elif self.killed:
             if self.all_task_attempts_done_or_failed():
                 # Rule 1: Task killed and all TaskAttempts have stopped; goal reached.
-                self.status = "KILLED_OR_FAILED"
+                self.setStatus("KILLED_OR_FAILED")
+            else:
+                self.pool.sleep(self)
         elif not self.taskResourcesAvailable():
             # Rule 2: Task preconditions not met (missing resources); fail.
             self.kill()
+        elif self.commitLocator == None and self.failedAttempts >= MAX_ATTEMPTS:
+            # Rule 3: Attempts keep failing; fail.
+            print "Task failed after {0} attempts: {1}".format(self.failedAttempts, self.work)
+            self.kill()
         elif self.commitLocator == None:
-            # Rule 3: Task not complete last iteration; check and add attempt if needed.
+            # Rule 4: Task not complete last iteration; check and add attempt if needed.
             for taskAttempt in list(self.taskAttempts):
                 if taskAttempt.getStatus() == "FAILED":
                     self.taskAttempts.remove(taskAttempt)
                 elif taskAttempt.getStatus() == "SUCCEEDED":
                     if self.commitLocator == None:
                         self.commitLocator = taskAttempt.container
-                else:
-                    if self.commitLocator != None:
+            if self.commitLocator != None:
+                # the first attempt to succeed is committed; kill the others
+                for taskAttempt in self.taskAttempts:
+                    if taskAttempt.getStatus() == "RUNNING":
                         taskAttempt.kill()
             if self.shouldAddAttempt():
-                self.taskAttempts.append(TaskAttempt(self.work, self.pool, self.rpcManager, self.eventQueue))
+                self.addAttempt()
+            if self.commitLocator == None:
+                self.pool.sleep(self)
         else:
-            # Rule 4: Task completed; goal reached.
-            self.status = "SUCCEEDED"
+            # Rule 5: Task completed; goal reached.
+            self.setStatus("SUCCEEDED")
             
     def handleEvents(self, newEvents):
         pass
         
     def getStatus(self):
         return self.status
-        
+
+    def setStatus(self, status):
+        if self.parent != None and status != self.status:
+            self.parent.taskStatusChanged(self, self.status, status)
+        self.status = status
+
     def all_task_attempts_done_or_failed(self):
-        for taskAttempt in self.taskAttempts:
-            if taskAttempt.getStatus() not in ("SUCCEEDED", "FAILED"):
-                return False
-        return True
+        return self.runningAttempts == 0
+
+    # Keep runningAttempts current; called by a TaskAttempt whenever its
+    # status changes.
+    def attemptStatusChanged(self, oldStatus, newStatus):
+        if oldStatus == "RUNNING":
+            self.runningAttempts -= 1
+        elif newStatus == "RUNNING":
+            self.runningAttempts += 1
         
-    # Some policy for whether an attempt should be issued.
-    # Same affect as if an event T_ADD_SPEC_ATTEMPT was generated
+    # Some policy for whether an attempt should be issued; speculative
+    # attempts are added by the Job (see Job.speculate).
     def shouldAddAttempt(self):
         if len(self.taskAttempts) == 0:
             return True
+
+    def addAttempt(self, speculative=False):
+        taskAttempt = TaskAttempt(self.work, self.pool, self.rpcManager, self.eventQueue, self)
+        taskAttempt.speculative = speculative
+        taskAttempt.stage = self.stage
+        if speculative:
+            # run the duplicate on a different worker from the original
+            for other in self.taskAttempts:
+                if other.getStatus() == "RUNNING" and other.container != None:
+                    taskAttempt.avoid = other.container[0]
+        self.taskAttempts.append(taskAttempt)
+        self.runningAttempts += 1
+
+    # Launch time of the task's only running attempt while it is still
+    # working, or None if the task cannot be speculated.
+    def launchTime(self):
+        if self.status != "RUNNING" or self.killed or self.runningAttempts != 1:
+            return None
+        for taskAttempt in self.taskAttempts:
+            if taskAttempt.getStatus() == "RUNNING" and taskAttempt.isWorking():
+                return taskAttempt.time
+        return None
+
+    def attemptFinished(self, runtime):
+        if self.parent != None:
+            self.parent.attemptFinished(runtime)
+
+    # Called by an attempt whose LAUNCH or COMMIT the worker failed.
+    def attemptFailed(self):
+        self.failedAttempts += 1
+
+    # Only the first attempt to finish may commit, unless it fails (Hadoop's
+    # canCommit); otherwise an attempt and its speculative copy could both
+    # write the task's output.
+    def canCommit(self, taskAttempt):
+        if self.committer == None or self.committer.getStatus() == "FAILED":
+            self.committer = taskAttempt
+        return self.committer is taskAttempt
             
     def kill(self):
         self.killed = True
@@ -180,12 +379,13 @@ class Task(object):
             taskAttempt.kill()
         self.pool.activate(self)
         
-    def nodeCrash(self, container):
-        if self.status != "KILLED_OR_FAILED" and container == self.commitLocator:
+    def nodeCrash(self, locator):
+        if (self.status != "KILLED_OR_FAILED" and self.commitLocator != None and
+                self.commitLocator[0] == locator):
             self.commitLocator = None
-            self.status = "RUNNING"
+            self.setStatus("RUNNING")
         for taskAttempt in self.taskAttempts:
-            taskAttempt.nodeCrash(container)
+            taskAttempt.nodeCrash(locator)
         self.pool.activate(self)
     
     # A check to see if the rescoures like the HDFS stored file are all online.
@@ -196,7 +396,13 @@ class Task(object):
         return "<{0}: {1} {2}>".format(self.work, self.getStatus(), self.commitLocator)
 
 class TaskAttempt(object):
-    def __init__(self, work, pool, rpcManager, eventQueue):
+    eventTypes = frozenset(("TA_ASSIGNED", "TA_KILL"))
+    __slots__ = ("work", "status", "container", "container_requested",
+                 "launch_rpc", "commit_rpc", "cleanup_rpc", "time",
+                 "speculative", "avoid", "stage", "pool", "rpcManager",
+                 "eventQueue", "parent")
+
+    def __init__(self, work, pool, rpcManager, eventQueue, parent=None):
         self.work = work
         self.status = "RUNNING"
         self.container = None
@@ -205,10 +411,15 @@ class TaskAttempt(object):
         self.commit_rpc = None
         self.cleanup_rpc = None
         self.time = None
+        # the allocator serves speculative attempts first and preempts reduces
+        self.speculative = False
+        # locator of a worker the allocator must not place the attempt on
+        self.avoid = None
+        self.stage = "MAP"
         self.pool = pool
         self.rpcManager = rpcManager
         self.eventQueue = eventQueue
-        self.eventsIn = deque()
+        self.parent = parent
         # schedule itself to run
         self.pool.activate(self)
         
@@ -221,51 +432,66 @@ class TaskAttempt(object):
             if not self.container_requested:
                 self.eventQueue.append(("CONTAINER_REQ", (self, None)))
                 self.container_requested = True
+            self.pool.sleep(self)
         elif self.cleanup_rpc != None:   
             # Cleanup requested (attempt killed); ensure cleanup occurs.
             if self.cleanup_rpc.status == "complete":
                 if self.cleanup_rpc.reply == "failed":
                     # Rule 2: Cleanup RPC failed; retry.
-                    self.cleanup_rpc = RPC(self.container, None, ("CONTAINER_REMOTE_CLEANUP", self.work))
-                    self.rpcManager.send(self.cleanup_rpc)
+                    self.cleanup_rpc = self.sendRPC("CONTAINER_REMOTE_CLEANUP")
                 else:
                     # Rule 3: Cleanup RPC completed; release container, goal reached.
                     self.eventQueue.append(("CONTAINER_DEALLOCATE", (self, self.container)))
-                    self.status = "FAILED"
+                    self.setStatus("FAILED")
+            else:
+                self.pool.sleep(self)
         elif self.launch_rpc == None:
             # Rule 4: Attempt not launched; launch.
-            self.launch_rpc = RPC(self.container, None, ("LAUNCH", self.work))
-            self.rpcManager.send(self.launch_rpc)
+            self.launch_rpc = self.sendRPC("LAUNCH")
             self.time = time.time()
         elif self.launch_rpc.status != "complete":
             # Placeholder for state with nothing to do (Attempt running).
-            pass
+            self.pool.sleep(self)
         elif self.launch_rpc.reply == "failed":
             # Rule 5: Attempt failed; report container failure, goal reached.
             self.eventQueue.append(("CONTAINER_FAILED", (self, self.container)))
-            self.status = "FAILED"
+            self.setStatus("FAILED")
+            if self.parent != None:
+                self.parent.attemptFailed()
         elif self.commit_rpc == None:
-            # Rule 6: Attempt complete but not committed; request commit.
-            self.commit_rpc = RPC(self.container, None, ("COMMIT", self.work))
-            self.rpcManager.send(self.commit_rpc)
+            # Rule 6: Attempt complete but not committed; request commit, or
+            # if another attempt of the task got to commit first, kill it.
+            if self.parent == None or self.parent.canCommit(self):
+                self.commit_rpc = self.sendRPC("COMMIT")
+                if self.parent != None:
+                    self.parent.attemptFinished(time.time() - self.time)
+            else:
+                self.kill()
         elif self.commit_rpc.status != "complete":
             # Placeholder for state with nothing to do (Attempt committing).
-            pass
+            self.pool.sleep(self)
         elif self.commit_rpc.reply == "failed":
             # Rule 7: Commit failed; report container failure, goal reached.
             self.eventQueue.append(("CONTAINER_FAILED", (self, self.container)))
-            self.status = "FAILED"
+            self.setStatus("FAILED")
+            if self.parent != None:
+                self.parent.attemptFailed()
         else:
             # Rule 8: Commit succeeded; release container, goal reached.
-            self.status = "SUCCEEDED"
+            self.setStatus("SUCCEEDED")
             self.eventQueue.append(("CONTAINER_DEALLOCATE", (self, self.container)))
 
+    # Send an RPC to the container, a (worker locator, slot) pair; this
+    # attempt is woken once it completes or fails.
+    def sendRPC(self, rpcType):
+        locator, slot = self.container
+        rpc = self.rpcManager.send(RPC(locator, None, (rpcType, (self.work, slot))))
+        rpc.addCallback(self.rpcDone)
+        return rpc
                 
     def handleEvents(self, newEvents):
-        self.eventsIn += newEvents
-
         # Turn events into state changes
-        for eventType, value in list(self.eventsIn):
+        for eventType, value in newEvents:
             # TaskAttemptEventType Events
             if eventType == "TA_ASSIGNED":
                 taskAttempt, container = value
@@ -273,26 +499,48 @@ class TaskAttempt(object):
             if eventType == "TA_KILL":
                 taskAttempt, container = value
                 taskAttempt.kill()
-        self.eventsIn.clear()
     
     def assignContainer(self, container):
-        if self.container == None:
+        if self.status != "RUNNING":
+            # killed while it waited for the container; hand it back
+            self.eventQueue.append(("CONTAINER_DEALLOCATE", (self, container)))
+        elif self.container == None:
             print "Container Assigned: " + str(container) + " to " + str(self.work)
             self.container = container
+            self.pool.wake(self)
     
+    def rpcDone(self, rpc):
+        self.pool.wake(self)
+
+    # Launched and not yet replied to or killed.
+    def isWorking(self):
+        return (self.launch_rpc != None and self.launch_rpc.status != "complete"
+                and self.cleanup_rpc == None)
+
     def kill(self):
-        if self.status == "RUNNING" and self.container != None:
-            self.cleanup_rpc = RPC(self.container, None, ("CONTAINER_REMOTE_CLEANUP", self.work))
-            self.rpcManager.send(self.cleanup_rpc)
+        if self.status != "RUNNING" or self.cleanup_rpc != None:
+            pass
+        elif self.container != None:
+            self.cleanup_rpc = self.sendRPC("CONTAINER_REMOTE_CLEANUP")
+        else:
+            # Nothing runs yet; withdraw the container request.
+            if self.container_requested:
+                self.eventQueue.append(("CONTAINER_DEALLOCATE", (self, None)))
+            self.setStatus("FAILED")
         self.pool.activate(self)
         
-    def nodeCrash(self, container):
-        if self.container == container:
-            self.status = "FAILED"
+    def nodeCrash(self, locator):
+        if self.container != None and self.container[0] == locator:
+            self.setStatus("FAILED")
         self.pool.activate(self)
         
     def getStatus(self):
         return self.status
+
+    def setStatus(self, status):
+        if self.parent != None and status != self.status:
+            self.parent.attemptStatusChanged(self.status, status)
+        self.status = status
                     
     def __str__(self):
         return "<{0}: {1} {2}>".format(self.work, self.status, self.container)
@@ -0,0 +1,64 @@
+from session import earliest
+import time
+
+class EventLoop(object):
+    """Runs the modules of one process on a single thread.
+
+    Each pass receives whatever datagrams have arrived and fires the timers
+    that are due (see SessionManager.poll), then runs the steps added with
+    add(), in order, and sleeps in select until a packet arrives, one of the
+    extra readers becomes readable or the earliest step or timer is due.
+
+    A step added with a timeout function only runs when that function
+    returns 0, so modules that poll their own state (the RPC layer, the
+    allocator and committer heartbeats, the Pool) only run once woken. A
+    step added without one, or with everyPass, runs on every pass. Work that
+    only has to happen later belongs on a timer: see callLater().
+    """
+    def __init__(self, sessionManager, readers=()):
+        self.sessionManager = sessionManager
+        self.timers = sessionManager.timers
+        self.readers = list(readers)
+        # (step, timeout, everyPass) triples
+        self.steps = []
+        self.running = False
+        self.passes = 0
+        self.stepsRun = 0
+
+    # Run step() on passes where timeout() returns 0, or on every pass; the
+    # loop sleeps no longer than timeout() either way.
+    def add(self, step, timeout=None, everyPass=False):
+        self.steps.append((step, timeout, everyPass or timeout == None))
+
+    # Call callback(arg) in delay seconds; returns a timer for cancel().
+    def callLater(self, delay, callback, arg=None):
+        return self.timers.schedule(time.time() + delay, callback, arg)
+
+    def cancel(self, timer):
+        self.timers.cancel(timer)
+
+    def stop(self):
+        self.running = False
+
+    # Run until a step calls stop().
+    def run(self):
+        self.running = True
+        while True:
+            self.runSteps()
+            if not self.running:
+                break
+            self.sessionManager.wait(self.timeout(), self.readers)
+
+    def runSteps(self):
+        self.passes += 1
+        self.sessionManager.poll()
+        for step, timeout, everyPass in self.steps:
+            if everyPass or timeout() == 0:
+                step()
+                self.stepsRun += 1
+
+    # Seconds until the next step or timer is due.
+    def timeout(self):
+        return earliest([self.sessionManager.timeout()] +
+                        [timeout() for step, timeout, everyPass in self.steps
+                         if timeout != None])
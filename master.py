@@ -3,11 +3,22 @@
 """MapReduce Master.
 
 Usage:
-    master.py [-t <tc>] <IP> <PORT>
+    master.py [-cs] [-t <tc> | -m <map> -i <glob>] [-r <rc>] [--reducer=<name>] [--combiner=<name>] [--split=<mb>] [--record=<bytes>] [--slowstart=<f>] [--codec=<name>] <IP> <PORT>
 
 Options:
   -h --help                 Show this screen.
+  -c --columnar             Keep task state in NumPy columns (needs numpy).
+  -s --speculate            Rerun slow attempts on another container.
   -t --taskcount=<tc>       Number of tasks to be performed [default: 10].
+  -m --map=<map>            Name of the map function to run (see functions.py).
+  -i --input=<glob>         Input files of the map, one task per split.
+  -r --reduces=<rc>         Number of reduce tasks [default: 0].
+  --reducer=<name>          Reduce function of a map job [default: sum].
+  --combiner=<name>         Reduce function each map applies to its own output.
+  --split=<mb>              MB of input per map task [default: 64].
+  --record=<bytes>          Input is fixed-size records rather than lines [default: 0].
+  --slowstart=<f>           Fraction of maps done before reduces start [default: 0.05].
+  --codec=<name>            Payload codec of sent packets (see wire.py) [default: json].
 """
 from docopt import docopt
 from rpc import RPCManager
@@ -16,65 +27,128 @@ from RMContainerAllocator import RMContainerAllocator
 from CommitterEventHandler import CommitterEventHandler
 from job import Job
 from pool import Pool
+from functions import mapWork, reduceWork, MAPS, REDUCES
+from inputformat import getSplits
+from speculator import Speculator
+from loop import EventLoop
+from timer import TimerQueue
 
-from multiprocessing import Queue
 from collections import deque
+import glob
+import os
+import sys
 
 work = range(10)
+reduceList = []
+slowstart = 0.05
+jobClass = Job
+speculator = None
+codec = "json"
 
 def run(IP, PORT):
     # Simulated "event queue"
     eventQueue = deque()
     
-    # Process queue used for async rpc system.
-    processQ = Queue()
-    sessionManager = MasterSessionManager(IP, PORT, processQ)
+    # Queue of received messages handed from the sessions to the rpc system.
+    processQ = deque()
+    # Deadlines of the sessions, rpcs and tasks.
+    timers = TimerQueue()
+    sessionManager = MasterSessionManager(IP, PORT, processQ, timers, codec)
     rpcManager = RPCManager(sessionManager, processQ)
     containerAllocator = RMContainerAllocator(eventQueue, sessionManager)
+    rpcManager.handlers["REGISTER"] = containerAllocator.serverRegistered
     committerEventHandler = CommitterEventHandler(eventQueue)
-    printed = False;
-    serverList = []
-    assignedServers = []
     
-    pool = Pool()
+    # For server failure
+    def serverLost(locator):
+        print "serverList change"
+        eventQueue.append(("JOB_UPDATED_NODES", locator))
+    sessionManager.closeHandlers.append(serverLost)
+
+    pool = Pool(timers)
     
-    job = Job(work, pool, rpcManager, eventQueue)
+    job = jobClass(work, pool, rpcManager, eventQueue, speculator, reduceList,
+                   slowstart)
+    rpcManager.handlers["MAP_EVENTS"] = job.serveMapEvents
     
     # Simulate Delayed Job init and start.
     eventQueue.append(("JOB_INIT", job))
     eventQueue.append(("JOB_START", job))
     
-    while True:
-        # Simulate "event delivery"
+    def report():
+        if job.getStatus() == "SUCCEEDED":
+            print "Job Complete"
+        else:
+            print "Job Failed"
+        print job
+        print "Events delivered: {0} ignored: {1} queued: {2}".format(
+            pool.eventsDelivered, pool.eventsIgnored, pool.eventsQueued)
+        if speculator != None:
+            print "Speculative attempts: {0}".format(speculator.launched)
+        for locator, stats in sorted(sessionManager.stats().items()):
+            print "Session {0}: srtt {1:.4f} rto {2:.4f} retransmits {3}".format(
+                locator, stats["srtt"] or 0, stats["rto"], stats["retransmits"])
+        print "RPC tables: " + " ".join("{0} {1}".format(name, size)
+            for name, size in sorted(rpcManager.stats().items()))
+        print "Loop passes: {0} steps run: {1}".format(loop.passes, loop.stepsRun)
+
+    # Simulate "event delivery"
+    def deliverEvents():
         containerAllocator.pushNewEvents(eventQueue)
         committerEventHandler.pushNewEvents(eventQueue)
         pool.pushNewEvents(eventQueue)
         eventQueue.clear()
-        
-        # Simulate async mechanisums
-        sessionManager.poll()
-        rpcManager.poll()
-        containerAllocator.heartbeat()
-        committerEventHandler.heartbeat()
-        
-        # For server failure
-        for locator in serverList:
-            if (locator not in sessionManager.serverList()):
-                eventQueue.append(("JOB_UPDATED_NODES", locator))
-        if serverList != sessionManager.serverList():
-            print "serverList change"
-        serverList = sessionManager.serverList()
-    
-        # Run tasks
+
+    # Run tasks
+    printed = [False]
+    def runTasks():
         pool.poll()
+        if job.getStatus() != "RUNNING" and not printed[0]:
+            report()
+            printed[0] = True
 
-        if job.getStatus() == "SUCCEEDED" and not printed:
-            print "Job Complete"
-            print job
-            printed = True
+    # Each module runs only once it has work: queued events, received RPCs,
+    # a due heartbeat or a woken task.
+    loop = EventLoop(sessionManager)
+    loop.add(deliverEvents, lambda: 0 if len(eventQueue) > 0 else None)
+    loop.add(rpcManager.poll, rpcManager.timeout)
+    loop.add(containerAllocator.heartbeat, containerAllocator.timeout)
+    loop.add(committerEventHandler.heartbeat, committerEventHandler.timeout)
+    loop.add(runTasks, pool.timeout)
+    loop.run()
 
 if __name__ == '__main__':
     args = docopt(__doc__)
     print(args)
     work = range(int(args['--taskcount']))
+    numReduces = int(args['--reduces'])
+    reducer = None
+    if args['--map']:
+        # Workers look the functions up by name; a typo would fail every attempt.
+        for option, table in (('--map', MAPS), ('--reducer', REDUCES),
+                              ('--combiner', REDUCES)):
+            if args[option] != None and args[option] not in table:
+                sys.exit("Unknown {0} function {1}; choose from {2}".format(
+                    option[2:], args[option], ", ".join(sorted(table))))
+        # Workers open the input themselves, so hand them absolute paths.
+        paths = sorted(os.path.abspath(path) for path in glob.glob(args['--input']))
+        # Paths travel in the JSON of LAUNCH RPCs, which only carries text.
+        for path in paths:
+            try:
+                path.decode("utf-8")
+            except UnicodeDecodeError:
+                sys.exit("Input path is not UTF-8: {0!r}".format(path))
+        splits = getSplits(paths, int(float(args['--split']) * (1 << 20)),
+                           int(args['--record']))
+        work = [mapWork(i, args['--map'], split, numReduces, args['--combiner'])
+                for i, split in enumerate(splits)]
+        reducer = args['--reducer']
+    reduceList = [reduceWork(r, len(work), reducer) for r in range(numReduces)]
+    slowstart = float(args['--slowstart'])
+    codec = args['--codec']
+    if args['--columnar']:
+        from columnar import ColumnarJob
+        jobClass = ColumnarJob
+    if args['--speculate']:
+        speculator = Speculator()
     run(args['<IP>'], int(args['<PORT>']))
\ No newline at end of file
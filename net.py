@@ -1,5 +1,12 @@
+from wire import DATAGRAM
+import errno
 import socket
-from multiprocessing import Process, Queue
+
+# Datagrams read from the socket per call to RecvPipe.recvBatch().
+BATCH = 64
+# Socket receive buffer asked for, to hold bursts of fragments between two
+# passes of the event loop (the kernel may grant less).
+RCVBUF = 4 << 20
 
 class NetPipe(object):
     def __init__(self, IP, PORT):
@@ -8,32 +15,50 @@ class NetPipe(object):
         self.sock = socket.socket(socket.AF_INET, # Internet
                                   socket.SOCK_DGRAM) # UDP
 
-class SendPipe(NetPipe):
-    def __init__(self, IP, PORT):
-        NetPipe.__init__(self, IP, PORT)
+class SendSocket(object):
+    """The one socket a process sends all of its datagrams from."""
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.datagrams = 0
 
-    def send(self, data):
-        self.sock.sendto(data, (self.UDP_IP, self.UDP_PORT))
+    def send(self, data, address):
+        self.sock.sendto(data, address)
+        self.datagrams += 1
 
 class RecvPipe(NetPipe):
-    def __init__(self, IP, PORT):
+    """Receives the datagrams sent to IP:PORT in this process.
+
+    The socket is non-blocking; recvBatch() drains up to batch datagrams
+    into one buffer that is reused by every call, so receiving copies each
+    datagram once and allocates nothing but the views of it.
+    """
+    def __init__(self, IP, PORT, batch=BATCH):
         NetPipe.__init__(self, IP, PORT)
         self.sock.bind((self.UDP_IP, self.UDP_PORT))
-        self.q = Queue()
-        self.listener = Process(target=RecvPipe.__listen, args=(self, ))
-        self.listener.deamon = True
-    
-    def __listen(self):
-        while True:
-            self.q.put(self.sock.recvfrom(1024))
-    
-    def start(self):
-        self.listener.start()
-
-    def empty(self):
-        return self.q.empty()
-
-    def recv(self):
-        if self.q.empty():
-            return None
-        return self.q.get_nowait()
\ No newline at end of file
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+        self.batch = batch
+        self.buffer = memoryview(bytearray(batch * DATAGRAM))
+
+    # Memoryviews of the datagrams waiting, at most batch of them; they are
+    # only valid until the next call.
+    def recvBatch(self):
+        packets = []
+        offset = 0
+        while len(packets) < self.batch:
+            try:
+                size, address = self.sock.recvfrom_into(
+                    self.buffer[offset:offset + DATAGRAM])
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            packets.append(self.buffer[offset:offset + size])
+            offset += DATAGRAM
+        return packets
+
+    # Readable (for select) whenever a datagram is waiting.
+    def fileno(self):
+        return self.sock.fileno()
@@ -1,20 +1,106 @@
-from collections import deque
+from timer import TimerQueue
+import time
 
 class Pool(object):
-    def __init__(self):
+    """Runs the rules of active tasks.
+
+    A task is only re-run when one of its inputs may have changed: it was
+    (re)activated, an event addressed to it arrived, one of its children
+    reached a goal state, an RPC it waits on changed status or a timer it
+    set expired. A task that finds no rule to fire calls sleep() and stays
+    idle until one of these wakes it up again.
+
+    Events are routed rather than broadcast: an event goes to the task it
+    names (its value, or the first item of a tuple value) if that task
+    handles its type, otherwise to every task subscribed to the type.
+    Each event is delivered once and then discarded.
+    """
+    def __init__(self, timers=None):
         self.taskSet = set()
-        self.eventsIn = deque()
-    
+        self.runnable = set()
+        if timers == None:
+            timers = TimerQueue()
+        self.timers = timers
+        self.inbox = {}
+        self.subscribers = {}
+        self.evaluations = 0
+        self.eventsDelivered = 0
+        self.eventsIgnored = 0
+        self.eventsQueued = 0
+
     def poll(self):
-        for t in list(self.taskSet):
-            t.handleEvents(self.eventsIn)
+        self.timers.expire()
+        ready = self.runnable
+        self.runnable = set()
+        for t in ready:
+            if t not in self.taskSet:
+                continue
+            # Tasks stay runnable until they report that they are waiting.
+            self.runnable.add(t)
+            t.handleEvents(self.takeEvents(t))
             t.applyRules()
+            self.evaluations += 1
 
     def activate(self, task):
         self.taskSet.add(task)
-    
+        self.runnable.add(task)
+
     def deactivate(self, task):
         self.taskSet.remove(task)
-            
+        self.runnable.discard(task)
+        self.takeEvents(task)
+        # A child reaching its goal state is an input of its parent's rules.
+        if task.parent != None:
+            self.wake(task.parent)
+
+    def wake(self, task):
+        if task in self.taskSet:
+            self.runnable.add(task)
+
+    def sleep(self, task):
+        self.runnable.discard(task)
+
+    def wakeAfter(self, task, delay):
+        return self.timers.schedule(time.time() + delay, self.wake, task)
+
+    # Deliver events of eventType that name no task to task.
+    def subscribe(self, task, eventType):
+        self.subscribers.setdefault(eventType, set()).add(task)
+
+    def unsubscribe(self, task, eventType):
+        self.subscribers.get(eventType, set()).discard(task)
+
+    def takeEvents(self, task):
+        events = self.inbox.pop(task, ())
+        self.eventsQueued -= len(events)
+        return events
+
+    def deliver(self, task, event):
+        if task not in self.taskSet:
+            self.eventsIgnored += 1
+            return
+        self.inbox.setdefault(task, []).append(event)
+        self.eventsQueued += 1
+        self.eventsDelivered += 1
+        self.runnable.add(task)
+
+    # Seconds until poll() next has a task to run, or None if only an event
+    # or an RPC can wake one.
+    def timeout(self):
+        if len(self.runnable) > 0:
+            return 0
+        return self.timers.timeout()
+
     def pushNewEvents(self, newEvents):
-        self.eventsIn += newEvents
\ No newline at end of file
+        for event in newEvents:
+            eventType, target = event
+            if isinstance(target, tuple):
+                target = target[0]
+            if eventType in getattr(target, "eventTypes", ()):
+                self.deliver(target, event)
+            elif eventType in self.subscribers:
+                for task in list(self.subscribers[eventType]):
+                    self.deliver(task, event)
+            else:
+                # Not a scheduler event (e.g. CONTAINER_REQ).
+                self.eventsIgnored += 1
@@ -1,7 +1,16 @@
+from session import INITIAL_RTO
 import time
-import json
+import weakref
+
+# Statuses of an RPC this process sent, each with a table in outRPC.
+OUT_STATUSES = ("pending", "acked", "complete", "failed")
+# Statuses an outgoing RPC ends in.
+DONE_STATUSES = ("complete", "failed")
 
 class RPC(object):
+    __slots__ = ("locator", "id", "msg", "reply", "temp", "status", "time",
+                 "callbacks", "timer", "attempts", "seq", "__weakref__")
+
     def __init__(self, locator, rcpId, msg):
         self.locator = locator
         self.id = rcpId
@@ -10,6 +19,32 @@ class RPC(object):
         self.temp = None
         self.status = "pending"
         self.time = time.time()
+        # functions to call with this RPC once it completes or fails
+        self.callbacks = None
+        self.timer = None
+        self.attempts = 0
+        # session sequence number of the message sent, or of the reply
+        self.seq = None
+
+    # Update the status; once the RPC is done, run its callbacks.
+    def setStatus(self, status):
+        self.status = status
+        if status in DONE_STATUSES and self.callbacks != None:
+            callbacks, self.callbacks = self.callbacks, None
+            for callback in callbacks:
+                callback(self)
+
+    def done(self):
+        return self.status in DONE_STATUSES
+
+    # Call callback(rpc) when the RPC completes or fails, or now if it has.
+    def addCallback(self, callback):
+        if self.done():
+            callback(self)
+        elif self.callbacks == None:
+            self.callbacks = [callback]
+        else:
+            self.callbacks.append(callback)
     
     def __str__(self):
         s = "<" , self.locator, ", "
@@ -23,76 +58,216 @@ class RPCManager(object):
     def __init__(self, sessionManager, inQ):
         self.inQ = inQ
         self.sessionManager = sessionManager
+        # Incoming RPCs being served, (locator, id) -> rpc; each leaves once
+        # its reply is sent, and the reply waits in unacked for its ack.
         self.inRPC = {}
-        self.outRPC = {}
+        # Outgoing RPCs by status, each table (locator, id) -> rpc. Pending
+        # and acked ones are held until they finish, complete and failed ones
+        # only as long as their owner holds them, so nothing piles up.
+        self.outRPC = {"pending": {}, "acked": {},
+                       "complete": weakref.WeakValueDictionary(),
+                       "failed": weakref.WeakValueDictionary()}
         self.counter = 0
+        # (locator, seq) -> (kind, rpc) of messages and replies sent and not
+        # yet acked, and locator -> greatest cumulative ack from it
+        self.unacked = {}
+        self.peerAcks = {}
+        # RPC type -> function serving incoming RPCs of that type in this
+        # process; it must set rpc.reply and rpc.status = "send"
+        self.handlers = {}
+        self.timers = sessionManager.timers
+        sessionManager.closeHandlers.append(self.sessionClosed)
     
     def poll(self):
         # Get incomming RPC
-        while not self.inQ.empty():
-            locator, datastr = self.inQ.get()
-            rpcId, kind, data = json.loads(datastr)
+        while len(self.inQ) > 0:
+            locator, kind, rpcId, data = self.inQ.popleft()
             # 0 is sender
             if kind == "msg":
-                if (locator, rpcId) not in self.inRPC.keys():
+                if (locator, rpcId) not in self.inRPC:
                     self.inRPC[(locator, rpcId)] = RPC(locator, rpcId, data)
-                rpc = self.inRPC[(locator, rpcId)]
-                if rpc.status == "complete":
-                    # resend reply
-                    self.sessionManager.send(rpc.locator,
-                                             json.dumps((rpc.id,
-                                                         "reply",
-                                                         rpc.reply)))
-                    print "RPC Replied"
-                else:
-                    # send ack
-                    self.sessionManager.send(locator,
-                                             json.dumps((rpcId, "ack", None)))
+                    if data[0] in self.handlers:
+                        self.handlers[data[0]](self.inRPC[(locator, rpcId)])
             elif kind == "reply":
-                if (locator, rpcId) in self.outRPC.keys():
-                    self.outRPC[(locator, rpcId)].reply = data
-                    self.outRPC[(locator, rpcId)].status = "complete"
+                rpc = self.inFlight((locator, rpcId))
+                if rpc != None:
+                    self.stopTimer(rpc)
+                    if self.unacked.pop((locator, rpc.seq), None) != None:
+                        # the ack was lost or is yet to come
+                        self.measure(rpc)
+                    rpc.reply = data
+                    self.setStatus(rpc, "complete")
                     print "RPC Complete"
             elif kind == "ack":
-                if (locator, rpcId) in self.outRPC.keys():
-                    rpc = self.outRPC[(locator, rpcId)]
-                    if rpc.status == "pending":
-                        rpc.status = "acked"
-                if (locator, rpcId) in self.inRPC.keys():
-                    del self.inRPC[(locator, rpcId)]
+                # rpcId is the cumulative ack, data any sequence numbers
+                # acked past it
+                session = self.sessionManager.sessions.get(locator)
+                if session == None:
+                    continue
+                acked = self.peerAcks.get(locator, 0)
+                last = min(rpcId, session.sent)
+                for seq in xrange(acked + 1, last + 1):
+                    self.acknowledge(locator, seq)
+                self.peerAcks[locator] = max(acked, last)
+                for seq in data or ():
+                    self.acknowledge(locator, seq)
 
         # send out rpc reply
-        for rpc in self.inRPC.values():
+        for key, rpc in self.inRPC.items():
             if rpc.status == "send":
-                self.sessionManager.send(rpc.locator,
-                                         json.dumps((rpc.id,
-                                                     "reply",
-                                                     rpc.reply)))
+                del self.inRPC[key]
                 rpc.status = "complete"
-                rpc.time = time.time()
+                rpc.attempts = 0
+                self.transmitReply(rpc)
                 print "RPC Replied"
-        # check on outstanding RPCs
-        for key in self.outRPC.keys():
-            rpc = self.outRPC[key]
-            # mark rpc failed if server dies
-            if rpc.locator not in self.sessionManager.serverList():
-                if rpc.status != "failed":
-                    rpc.status = "failed"
-                    print "RPC Failed"
-            # resend RPC is no ack is recived in time
-            if rpc.status == "pending" and (time.time() - rpc.time) > 0.25:
-                self.send(rpc)
-                
-            
 
+    # The outgoing RPC with key (locator, id), if it has not finished.
+    def inFlight(self, key):
+        rpc = self.outRPC["pending"].get(key)
+        if rpc == None:
+            rpc = self.outRPC["acked"].get(key)
+        return rpc
+
+    # Cancel an RPC's retransmission; the timer refers back to the RPC, so
+    # drop it too, letting the RPC go as soon as nothing else holds it.
+    def stopTimer(self, rpc):
+        self.timers.cancel(rpc.timer)
+        rpc.timer = None
+
+    # Move an outgoing RPC to the table of its new status and wake its owner.
+    def setStatus(self, rpc, status):
+        key = (rpc.locator, rpc.id)
+        self.outRPC[rpc.status].pop(key, None)
+        self.outRPC[status][key] = rpc
+        rpc.setStatus(status)
+
+    # The packet with sequence number seq reached locator: an RPC's message,
+    # which no longer needs resending, or a reply, which ends the RPC here.
+    def acknowledge(self, locator, seq):
+        entry = self.unacked.pop((locator, seq), None)
+        if entry == None:
+            return
+        kind, rpc = entry
+        self.stopTimer(rpc)
+        self.measure(rpc)
+        if kind == "msg":
+            self.setStatus(rpc, "acked")
+
+    # Timer callback: resend an RPC that has not been acked in time.
+    def retransmit(self, rpc):
+        if rpc.status != "pending":
+            return
+        session = self.sessionManager.sessions.get(rpc.locator)
+        if session == None:
+            self.fail(rpc)
+            return
+        session.retransmits += 1
+        session.backoff(rpc.time)
+        self.transmit(rpc)
+
+    # Timer callback: resend a reply that has not been acked in time; give
+    # it up if the caller is gone.
+    def retransmitReply(self, rpc):
+        if (rpc.locator, rpc.seq) not in self.unacked:
+            return
+        session = self.sessionManager.sessions.get(rpc.locator)
+        if session == None:
+            del self.unacked[(rpc.locator, rpc.seq)]
+            return
+        session.retransmits += 1
+        session.backoff(rpc.time)
+        self.transmitReply(rpc)
+
+    # Time the round trip of a message or reply to its ack, unless it was
+    # resent, since the ack may then be for any of the copies (Karn).
+    def measure(self, rpc):
+        session = self.sessionManager.sessions.get(rpc.locator)
+        if session != None and rpc.attempts == 1:
+            session.measure(time.time() - rpc.time)
+
+    # Session close handler: fail every RPC sent to the dead server and
+    # forget the replies it will never ack. Its acks, still queued or not,
+    # number packets of the closed session.
+    def sessionClosed(self, locator):
+        for status in ("pending", "acked"):
+            for rpc in self.outRPC[status].values():
+                if rpc.locator == locator:
+                    self.fail(rpc)
+        for key in [key for key in self.unacked if key[0] == locator]:
+            kind, rpc = self.unacked.pop(key)
+            self.stopTimer(rpc)
+        self.peerAcks.pop(locator, None)
+        for entry in [entry for entry in self.inQ
+                      if entry[0] == locator and entry[1] == "ack"]:
+            self.inQ.remove(entry)
+
+    def fail(self, rpc):
+        self.stopTimer(rpc)
+        self.unacked.pop((rpc.locator, rpc.seq), None)
+        if rpc.status != "failed":
+            self.setStatus(rpc, "failed")
+            print "RPC Failed"
+
+    # Seconds until poll() next has work to do; retransmits are timers in
+    # the session manager's queue, so only queued messages and replies count.
+    def timeout(self):
+        if len(self.inQ) > 0:
+            return 0
+        for rpc in self.inRPC.values():
+            if rpc.status == "send":
+                return 0
+        return None
+
+    # Sizes of the RPC tables.
+    def stats(self):
+        stats = dict((status, len(self.outRPC[status]))
+                     for status in OUT_STATUSES)
+        stats["serving"] = len(self.inRPC)
+        stats["unacked"] = len(self.unacked)
+        return stats
+
+    # Seconds to wait for the ack of an RPC's latest transmission: the
+    # session's RTO, which backs off as packets go unacked.
+    def rto(self, rpc):
+        session = self.sessionManager.sessions.get(rpc.locator)
+        if session == None:
+            return INITIAL_RTO
+        return session.rto
+
+    # Send an RPC and return it as the handle to its result: poll its status
+    # or have addCallback() say when it is done.
     def send(self, rpc):
-        rpc.id = "{0}:{1}:{2}".format(self.sessionManager.locator,
-                                      rpc.locator,
-                                      self.counter)
+        # ids are unique per sender; pings carry 0
         self.counter += 1
-        self.outRPC[(rpc.locator, rpc.id)] = rpc
-        self.sessionManager.send(rpc.locator, json.dumps((rpc.id,
-                                                          "msg",
-                                                          rpc.msg)))
-        rpc.time = time.time()
+        rpc.id = self.counter
+        rpc.status = "pending"
+        self.outRPC["pending"][(rpc.locator, rpc.id)] = rpc
+        self.transmit(rpc)
+        return rpc
+
+    # Send, or resend under the same id and sequence number, an RPC's
+    # message, and resend it again if no ack comes in time.
+    def transmit(self, rpc):
+        self.sendPacket(rpc, "msg", rpc.msg, self.retransmit)
         print "RPC Sent"
+
+    # Send, or resend, the reply to an incoming RPC; the callee keeps it
+    # until the caller acks it.
+    def transmitReply(self, rpc):
+        if not self.sendPacket(rpc, "reply", rpc.reply, self.retransmitReply):
+            # the caller is gone
+            self.stopTimer(rpc)
+
+    def sendPacket(self, rpc, kind, payload, retransmit):
+        seq = self.sessionManager.send(rpc.locator, kind, rpc.id, payload,
+                                       rpc.seq or 0)
+        rpc.time = time.time()
+        rpc.attempts += 1
+        self.timers.cancel(rpc.timer)
+        rpc.timer = self.timers.schedule(rpc.time + self.rto(rpc),
+                                         retransmit, rpc)
+        if seq == None:
+            return False
+        rpc.seq = seq
+        self.unacked[(rpc.locator, seq)] = (kind, rpc)
+        return True
@@ -1,20 +1,90 @@
 from net import *
+from timer import TimerQueue
+from wire import (DATAGRAM, HEADER, RECORD, Encoder, Reassembly, WireError,
+                  decodeBatch, decodeFragment, decodeHeader, decodePayload,
+                  fragments)
+import select
 import time
-import json
 from random import randint
 
 RETRY = 0.5
 WORRY = 8
 TIMEOUT = 10
+# Seconds without a new fragment of a payload before the missing ones are
+# asked for again, and seconds a sent or partly received payload is kept.
+NACK_DELAY = 0.05
+FRAGMENT_HOLD = 2.0
+# Most missing fragments asked for in one nack.
+MAX_NACK = 150
+# Bounds of a session's retransmission timeout (RTO), which starts at
+# INITIAL_RTO until the first round trip is measured.
+INITIAL_RTO = 0.25
+MIN_RTO = 0.1
+MAX_RTO = 8.0
+# Least margin the RTO leaves above the smoothed round trip time, for
+# passes of the peer's event loop.
+GRANULARITY = 0.05
+# Seconds a received "msg" or "reply" packet may wait for a packet to carry
+# its ack before the ack is sent on its own, and most sequence numbers
+# received past a gap listed in it.
+ACK_DELAY = 0.02
+MAX_SACK = 100
+# Most sequence numbers a session accepts past the last one received in
+# order; later ones are dropped unacked, so the set of them stays bounded.
+RECEIVE_WINDOW = 4096
+# Kinds of packets that are numbered, acked and delivered once.
+SEQUENCED = ("msg", "reply")
 
 
+# The smallest of a list of timeouts, where None means no timeout.
+def earliest(timeouts):
+    timeouts = [t for t in timeouts if t != None]
+    if len(timeouts) == 0:
+        return None
+    return min(timeouts)
+
 class Session(object):
     def __init__(self, IP, PORT, ID, manager):
         self.locator = (IP, PORT, ID)
         self.manager = manager
-        self.sender = SendPipe(IP, PORT)
+        self.address = (IP, PORT)
         self.txTime = 0
         self.rxTime = 0
+        # (kind, rpcId) -> [body, timer, seq] of fragmented payloads sent,
+        # and Reassembly of those being received
+        self.outgoing = {}
+        self.incoming = {}
+        # (kind, rpcId, seq, body) of short packets waiting for flush()
+        self.queue = []
+        # smoothed round trip time and its mean deviation, None until the
+        # first sample
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.backoffTime = 0
+        self.samples = 0
+        self.retransmits = 0
+        # This incarnation of the session and the peer's (0 until its first
+        # packet), which number their "msg" and "reply" packets from 1.
+        # Once the peer has echoed epoch it is confirmed: a new peer epoch
+        # after that means the peer lost its side of the session.
+        self.epoch = manager.newEpoch()
+        self.peerEpoch = 0
+        self.confirmed = False
+        # whether the latest packet received echoed this epoch, so its ack
+        # and sequence number belong to this incarnation
+        self.followed = False
+        # last sequence number sent
+        self.sent = 0
+        # Sequence numbers of the peer's packets received: all up to
+        # received, and those in beyond past a gap. Every packet sent
+        # carries received as its cumulative ack; ackTimer sends an "ack"
+        # packet if nothing else goes out in time.
+        self.received = 0
+        self.beyond = set()
+        self.ackTimer = None
+        # greatest cumulative ack from the peer
+        self.peerAck = 0
     
     def poll(self):
         Time = time.time()
@@ -25,54 +95,385 @@ class Session(object):
 
     def event(self):
         self.rxTime = time.time()
+
+    # Time at which poll() will next send a ping or the session expires.
+    def deadline(self):
+        return min(max(self.rxTime + WORRY, self.txTime + RETRY),
+                   self.rxTime + TIMEOUT)
     
-    def send(self, data):
+    # Fold a measured round trip time into the RTO (Jacobson/Karels, as in
+    # RFC 6298).
+    def measure(self, rtt):
+        if self.srtt == None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt +
+                                    max(GRANULARITY, 4 * self.rttvar)))
+        self.samples += 1
+
+    # Double the RTO after a message sent at sent went unacked, once per
+    # RTO however many messages time out together; it stays backed off
+    # until the next measurement.
+    def backoff(self, sent):
+        if sent >= self.backoffTime:
+            self.rto = min(MAX_RTO, self.rto * 2)
+            self.backoffTime = time.time()
+
+    def stats(self):
+        return {"srtt": self.srtt, "rttvar": self.rttvar, "rto": self.rto,
+                "samples": self.samples, "retransmits": self.retransmits}
+
+    # Note the receipt of the peer's packet number seq; returns False if it
+    # was received before. A repeat means the ack was lost, so it is acked
+    # at once; otherwise the ack waits up to the manager's ackDelay for a
+    # packet to ride on.
+    def receiveSequenced(self, seq):
+        if seq <= self.received or seq in self.beyond:
+            self.scheduleAck(time.time())
+            return False
+        if seq > self.received + RECEIVE_WINDOW:
+            # the sender will resend it once the gap is filled
+            return False
+        self.beyond.add(seq)
+        while self.received + 1 in self.beyond:
+            self.received += 1
+            self.beyond.remove(self.received)
+        self.scheduleAck(time.time() + self.manager.ackDelay)
+        return True
+
+    def scheduleAck(self, deadline):
+        if self.ackTimer != None:
+            if self.ackTimer.deadline <= deadline:
+                return
+            self.manager.timers.cancel(self.ackTimer)
+        self.ackTimer = self.manager.timers.schedule(deadline, self.sendAck)
+
+    # Track the peer's incarnation from a received packet's epoch and echo.
+    # Returns False if the peer lost the incarnation this session follows,
+    # so that the session must be replaced, and None for a stale packet from
+    # an earlier one.
+    def follow(self, epoch, echo):
+        if epoch < self.peerEpoch:
+            return None
+        if epoch != self.peerEpoch:
+            if self.confirmed:
+                return False
+            # the peer's stream starts over, from sequence number 1
+            self.peerEpoch = epoch
+            self.received = 0
+            self.beyond = set()
+        if echo == self.epoch:
+            self.confirmed = True
+        # a peer yet to hear from this session has acked nothing of it
+        self.followed = echo in (0, self.epoch)
+        return True
+
+    # Sequence number of the next "msg" or "reply" packet.
+    def nextSeq(self):
+        self.sent += 1
+        return self.sent
+
+    # Cumulative ack, epoch and echo for the header of a packet to send.
+    def stamp(self):
+        return self.ack(), self.epoch, self.peerEpoch
+
+    # Timer callback: nothing carried the ack in time, send it alone.
+    def sendAck(self, arg=None):
+        self.ackTimer = None
+        beyond = None
+        if len(self.beyond) > 0:
+            beyond = sorted(self.beyond)[:MAX_SACK]
+        self.send("ack", 0, beyond)
+
+    # The cumulative ack for the header of a packet about to be sent; it
+    # makes a pending ack unnecessary unless messages arrived past a gap.
+    def ack(self):
+        if self.ackTimer != None and len(self.beyond) == 0:
+            self.manager.timers.cancel(self.ackTimer)
+            self.ackTimer = None
+        return self.received
+
+    # Send a packet; "msg" and "reply" packets get the next sequence number
+    # unless resent under seq. Returns the sequence number.
+    def send(self, kind, rpcId=0, payload=None, seq=0):
         self.txTime = time.time()
-        packet = json.dumps((self.manager.locator, data))
-        print "TX: ", packet
-        self.sender.send(packet)
+        print "TX: ", self.locator, kind, rpcId, payload
+        if kind in SEQUENCED and seq == 0:
+            seq = self.nextSeq()
+        encoder = self.manager.encoder
+        body = encoder.body(payload)
+        self.manager.messagesSent += 1
+        if HEADER.size + len(body) <= DATAGRAM:
+            if not self.manager.coalesce:
+                self.transmit(encoder.header(kind, rpcId, seq, *self.stamp()) + body)
+                return seq
+            if len(self.queue) == 0:
+                self.manager.dirty.append(self)
+            self.queue.append((kind, rpcId, seq, body))
+            return seq
+        # keep the body to resend the fragments the receiver misses
+        key = (kind, rpcId)
+        timers = self.manager.timers
+        if key in self.outgoing:
+            timers.cancel(self.outgoing[key][1])
+        self.outgoing[key] = [body, timers.schedule(self.txTime + FRAGMENT_HOLD,
+                                                    self.forget, key), seq]
+        for index in range(fragments(body)):
+            self.transmit(encoder.fragment(kind, rpcId, body, index, seq,
+                                           *self.stamp()))
+        return seq
+
+    def transmit(self, data):
+        self.manager.sender.send(data, self.address)
+
+    # Send the queued packets, packing as many into each datagram as fit.
+    def flush(self):
+        queue = self.queue
+        self.queue = []
+        batch = []
+        size = HEADER.size
+        for record in queue:
+            length = RECORD.size + len(record[3])
+            if size + length > DATAGRAM:
+                self.transmitBatch(batch)
+                batch = []
+                size = HEADER.size
+            batch.append(record)
+            size += length
+        self.transmitBatch(batch)
+
+    def transmitBatch(self, batch):
+        if len(batch) == 1:
+            kind, rpcId, seq, body = batch[0]
+            self.transmit(self.manager.encoder.header(kind, rpcId, seq,
+                                                      *self.stamp()) + body)
+        elif len(batch) > 1:
+            self.transmit(self.manager.encoder.batch(batch, *self.stamp()))
+
+    def forget(self, key):
+        self.outgoing.pop(key, None)
+
+    # Handle a nack: resend the listed fragments of a payload.
+    def resend(self, rpcId, nack):
+        kind, indices = nack
+        entry = self.outgoing.get((kind, rpcId))
+        if entry == None:
+            return
+        body, timer, seq = entry
+        count = fragments(body)
+        for index in indices:
+            if 0 <= index < count:
+                self.transmit(self.manager.encoder.fragment(kind, rpcId, body,
+                                                            index, seq,
+                                                            *self.stamp()))
+
+    # Add a fragment to its payload; returns (kind, payload) once the payload
+    # is complete and (None, None) until then.
+    def reassemble(self, code, rpcId, packet):
+        kind, index, count, length, data = decodeFragment(packet)
+        key = (kind, rpcId)
+        reassembly = self.incoming.get(key)
+        if (reassembly == None or len(reassembly.received) != count or
+                len(reassembly.data) != length):
+            if reassembly != None:
+                self.manager.timers.cancel(reassembly.timer)
+            reassembly = Reassembly(code, count, length)
+            reassembly.timer = self.manager.timers.schedule(
+                time.time() + NACK_DELAY, self.nack, key)
+            self.incoming[key] = reassembly
+        reassembly.time = time.time()
+        reassembly.add(index, data)
+        if not reassembly.complete():
+            return None, None
+        del self.incoming[key]
+        self.manager.timers.cancel(reassembly.timer)
+        return kind, reassembly.payload()
+
+    # Timer callback: once fragments of a payload stop arriving, ask for the
+    # missing ones; give up after FRAGMENT_HOLD.
+    def nack(self, key):
+        reassembly = self.incoming.get(key)
+        if reassembly == None:
+            return
+        now = time.time()
+        if now - reassembly.time > FRAGMENT_HOLD:
+            del self.incoming[key]
+            return
+        if now - reassembly.time >= NACK_DELAY:
+            kind, rpcId = key
+            self.send("nack", rpcId, [kind, reassembly.missingIndices(MAX_NACK)])
+            reassembly.time = now
+        reassembly.timer = self.manager.timers.schedule(
+            reassembly.time + NACK_DELAY, self.nack, key)
 
 class SessionManager(object):
-    def __init__(self, IP, PORT, processQ):
+    def __init__(self, IP, PORT, processQ, timers=None, codec="json",
+                 coalesce=True):
         self.locator = (IP, PORT, randint(0,9999))
+        self.encoder = Encoder(self.locator, codec)
         self.receiver = RecvPipe(IP, PORT)
-        self.receiver.start()
+        self.sender = SendSocket()
+        # Short packets wait in their session's queue until flush(), which
+        # wait() calls before blocking, so those sent to a peer in one pass
+        # of the event loop share datagrams. Otherwise each is sent at once.
+        self.coalesce = coalesce
+        self.dirty = []
+        self.messagesSent = 0
+        self.ackDelay = ACK_DELAY
         self.sessions = {}
         self.processQ = processQ
-        self.nextSessionID = 1
+        # epoch of the next session opened
+        self.nextEpoch = 1
+        if timers == None:
+            timers = TimerQueue()
+        self.timers = timers
+        # called with the locator of every session that opens or expires
+        self.openHandlers = []
+        self.closeHandlers = []
 
     def poll(self):
         self.process()
-        for loc in self.sessions.keys():
-            self.sessions[loc].poll()
-        # Kill old sessions
-        for loc in self.sessions.keys():
-            if time.time() - self.sessions[loc].rxTime > TIMEOUT:
-                self.sessions.pop(loc)
+        self.timers.expire()
+
+    # Timer callback: ping the session if it has been quiet, kill it if it
+    # has timed out, otherwise check again at its next deadline.
+    def check(self, session):
+        if self.sessions.get(session.locator) is not session:
+            # replaced
+            return
+        session.poll()
+        if time.time() - session.rxTime > TIMEOUT:
+            self.close(session)
+        else:
+            self.timers.schedule(session.deadline(), self.check, session)
     
+    # Seconds until poll() next has work to do (any timer in self.timers).
+    def timeout(self):
+        return self.timers.timeout()
+
+    # Block until a packet arrives, one of readers is readable or timeout
+    # seconds pass (forever if None).
+    def wait(self, timeout, readers=()):
+        self.flush()
+        select.select([self.receiver] + list(readers), [], [], timeout)
+
+    # Send the packets queued in every session.
+    def flush(self):
+        dirty = self.dirty
+        self.dirty = []
+        for session in dirty:
+            session.flush()
+
+    # Datagrams sent, against messagesSent.
+    def datagramsSent(self):
+        return self.sender.datagrams
+
+    # Handle every datagram waiting on the socket.
     def process(self):
-        while not self.receiver.empty():
-            packet = self.receiver.recv()[0]
-            locator, data = json.loads(packet)
-            locator = tuple(locator)
-            if locator not in self.serverList():
-                self.sessions[locator] = Session(locator[0],
-                                                 locator[1], 
-                                                 locator[2],
-                                                 self)
-            self.sessions[locator].event()
-            if data == "ping":
-                print "RX: ", locator, data
-                self.sessions[locator].send("pong")
-            elif data == "pong":
-                print "RX: ", locator, data
+        packets = self.receiver.recvBatch()
+        while len(packets) > 0:
+            for packet in packets:
+                self.receive(packet)
+            if len(packets) < self.receiver.batch:
+                break
+            packets = self.receiver.recvBatch()
+
+    # Handle one datagram, a view into the receiver's buffer.
+    def receive(self, packet):
+        try:
+            locator, kind, code, rpcId, seq, ack, epoch, echo = decodeHeader(packet)
+        except WireError as e:
+            print "RX: bad packet", e
+            return
+        session = self.sessions.get(locator)
+        if session == None:
+            session = self.open(locator)
+        following = session.follow(epoch, echo)
+        if following == None:
+            return
+        if not following:
+            # the peer lost its side of the session: start a new one, and
+            # tell the peer its epoch
+            self.close(session)
+            session = self.open(locator)
+            session.follow(epoch, echo)
+            session.send("ping")
+        session.event()
+        if session.followed and ack > session.peerAck:
+            # hand the RPC layer the acks of its packets before any reply
+            session.peerAck = ack
+            if kind != "ack":
+                self.processQ.append((locator, "ack", ack, None))
+        try:
+            if kind == "batch":
+                for kind, code, rpcId, seq, data in decodeBatch(packet):
+                    self.deliver(session, kind, rpcId, seq,
+                                 decodePayload(code, data.tobytes()))
+                return
+            if kind == "frag":
+                kind, data = session.reassemble(code, rpcId, packet)
+                if kind == None:
+                    return
             else:
-                print "RX: ", locator, data
-                self.processQ.put((locator, data))
+                data = decodePayload(code, packet[HEADER.size:].tobytes())
+        except (WireError, ValueError, EOFError, TypeError) as e:
+            print "RX: bad packet", e
+            return
+        self.deliver(session, kind, rpcId, seq, data)
+
+    def open(self, locator):
+        session = Session(locator[0], locator[1], locator[2], self)
+        self.sessions[locator] = session
+        self.timers.schedule(time.time(), self.check, session)
+        for handler in self.openHandlers:
+            handler(locator)
+        return session
+
+    def close(self, session):
+        self.sessions.pop(session.locator)
+        self.timers.cancel(session.ackTimer)
+        for handler in self.closeHandlers:
+            handler(session.locator)
+
+    # Act on one packet, or one record of a batch, from session. Acks and
+    # numbered packets only count if the peer follows this incarnation.
+    def deliver(self, session, kind, rpcId, seq, data):
+        locator = session.locator
+        print "RX: ", locator, kind, rpcId, data
+        if kind == "ping":
+            session.send("pong")
+        elif kind == "nack":
+            session.resend(rpcId, data)
+        elif not session.followed:
+            # the peer is yet to learn this incarnation: a pong tells it
+            if kind != "pong":
+                session.send("pong")
+        elif kind == "ack":
+            # (locator, "ack", cumulative ack, sequence numbers past it)
+            self.processQ.append((locator, kind, session.peerAck, data))
+        elif kind in SEQUENCED:
+            if seq == 0 or session.receiveSequenced(seq):
+                self.processQ.append((locator, kind, rpcId, data))
 
-    def send(self, locator, data):
-        if locator in self.sessions.keys():
-            self.sessions[locator].send(data)
+    # Send a packet to the session with locator, if it is open; returns its
+    # sequence number (see Session.send), or None.
+    def send(self, locator, kind, rpcId=0, payload=None, seq=0):
+        if locator in self.sessions:
+            return self.sessions[locator].send(kind, rpcId, payload, seq)
+        return None
+
+    def newEpoch(self):
+        epoch = self.nextEpoch
+        self.nextEpoch += 1
+        return epoch
+
+    # locator -> Session.stats() of every open session.
+    def stats(self):
+        return dict((locator, session.stats())
+                    for locator, session in self.sessions.items())
 
     def serverList(self):
         return self.sessions.keys()
@@ -81,13 +482,19 @@ class MasterSessionManager(SessionManager):
     pass
 
 class WorkerSessionManager(SessionManager):
-    def __init__(self, IP, PORT, mIP, mPORT, processQ):
-        SessionManager.__init__(self, IP, PORT, processQ)
+    def __init__(self, IP, PORT, mIP, mPORT, processQ, timers=None, codec="json",
+                 coalesce=True):
+        SessionManager.__init__(self, IP, PORT, processQ, timers, codec, coalesce)
         self.defaultMasterSession = Session(mIP, mPORT, 0, self)
     
     def poll(self):
+        # Until the master answers, ping it every RETRY seconds; its reply
+        # opens the real session.
+        if len(self.sessions) == 0:
+            self.defaultMasterSession.poll()
+        SessionManager.poll(self)
+
+    def timeout(self):
         if len(self.sessions) == 0:
-            self.sessions[self.defaultMasterSession.locator] = self.defaultMasterSession
-        elif len(self.sessions) > 1 and self.defaultMasterSession.locator in self.sessions:
-            del self.sessions[self.defaultMasterSession.locator]
-        SessionManager.poll(self)
\ No newline at end of file
+            return max(0, self.defaultMasterSession.txTime + RETRY - time.time())
+        return SessionManager.timeout(self)
\ No newline at end of file
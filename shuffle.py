@@ -0,0 +1,101 @@
+"""Moves map output to the reducers.
+
+Every worker runs a ShuffleServer on the TCP port with the same number as
+its UDP port. A reducer asks it for one partition of one committed map
+output; the server looks the partition up in the output's index and sends
+that byte range straight out of an mmap of the file, so the data is never
+copied into a Python string. fetch() is the client side; reducers run many
+fetches at once in a thread pool.
+"""
+from functions import indexPath
+
+import SocketServer
+import json
+import mmap
+import os
+import socket
+import struct
+import threading
+import traceback
+
+# Seconds a fetch waits on a silent server.
+TIMEOUT = 10.0
+CHUNK = 1 << 16
+
+def mapOutputPath(directory, taskId):
+    return os.path.join(directory, "map-{0}.out".format(taskId))
+
+class ShuffleHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        taskId, partition = json.loads(self.rfile.readline())
+        path = mapOutputPath(self.server.directory, taskId)
+        try:
+            with open(indexPath(path)) as indexFile:
+                offset, length = json.load(indexFile)[partition]
+        except (IOError, ValueError, IndexError):
+            # not (or no longer) here; the reducer will look elsewhere
+            self.request.sendall(struct.pack("!q", -1))
+            return
+        self.request.sendall(struct.pack("!q", length))
+        if length == 0:
+            return
+        with open(path, "rb") as outputFile:
+            if self.server.zeroCopy:
+                data = mmap.mmap(outputFile.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    self.request.sendall(buffer(data, offset, length))
+                finally:
+                    data.close()
+            else:
+                outputFile.seek(offset)
+                self.request.sendall(outputFile.read(length))
+        self.server.bytesServed += length
+
+class ShuffleServer(SocketServer.ThreadingTCPServer):
+    """Serves partitions of the map outputs in directory, one thread per
+    request. zeroCopy=False reads each range into a string instead, for
+    comparison."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, IP, PORT, directory, zeroCopy=True):
+        SocketServer.ThreadingTCPServer.__init__(self, (IP, PORT), ShuffleHandler)
+        self.directory = directory
+        self.zeroCopy = zeroCopy
+        self.bytesServed = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+# Copy partition of map taskId's output from the worker at locator into
+# path; returns the number of bytes or "failed". Never raises, so that it
+# can run in a pool whose callback must always fire.
+def fetch(locator, taskId, partition, path):
+    sock = None
+    try:
+        sock = socket.create_connection((locator[0], locator[1]), TIMEOUT)
+        sock.sendall(json.dumps([taskId, partition]) + "\n")
+        reader = sock.makefile("rb")
+        header = reader.read(8)
+        if len(header) != 8:
+            return "failed"
+        length = struct.unpack("!q", header)[0]
+        if length < 0:
+            return "failed"
+        remaining = length
+        with open(path, "wb") as segment:
+            while remaining > 0:
+                chunk = reader.read(min(CHUNK, remaining))
+                if not chunk:
+                    return "failed"
+                segment.write(chunk)
+                remaining -= len(chunk)
+        return length
+    except Exception:
+        traceback.print_exc()
+        return "failed"
+    finally:
+        if sock != None:
+            sock.close()
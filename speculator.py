@@ -0,0 +1,52 @@
+import math
+
+class Speculator(object):
+    """Decides when a task's attempt is slow enough to be run again elsewhere.
+
+    Keeps the mean and variance of the runtimes (launch to LAUNCH reply) of
+    the attempts of one Job. Once minSamples attempts have finished, an
+    attempt still running after threshold() seconds is slow and its task may
+    get a speculative attempt on another container; the first attempt to
+    succeed wins and the Task rules kill the other. Subclass and override
+    threshold() for another policy.
+    """
+    def __init__(self, interval=1.0, minSamples=5, slowFactor=1.5,
+                 deviations=2.0, maxFraction=0.1, minAllowed=1, maxPerTask=1):
+        # seconds between two looks for slow attempts
+        self.interval = interval
+        self.minSamples = minSamples
+        self.slowFactor = slowFactor
+        self.deviations = deviations
+        # caps: speculating tasks at once, as a fraction of the job (but at
+        # least minAllowed), and speculative attempts over a task's life
+        self.maxFraction = maxFraction
+        self.minAllowed = minAllowed
+        self.maxPerTask = maxPerTask
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.launched = 0
+
+    def attemptFinished(self, runtime):
+        self.count += 1
+        delta = runtime - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (runtime - self.mean)
+
+    def deviation(self):
+        if self.count < 2:
+            return 0.0
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    # Seconds after which a running attempt is slow, or None while too few
+    # attempts have finished to tell.
+    def threshold(self):
+        if self.count < self.minSamples:
+            return None
+        return max(self.mean * self.slowFactor,
+                   self.mean + self.deviations * self.deviation())
+
+    # Speculative attempts that may be started now.
+    def allowed(self, numTasks, speculating):
+        cap = max(self.minAllowed, int(self.maxFraction * numTasks))
+        return max(0, cap - speculating)
@@ -0,0 +1,129 @@
+"""Bounded buffer for the output of one map attempt.
+
+A map's (partition, key, value) records are collected in memory until their
+estimated size reaches the buffer's limit; the buffer is then sorted by
+partition and key and spilled to a run file next to the output. close()
+spills what is left and merges the runs into the partitioned output file and
+the index of its partitions (see functions.runMap), streaming them so that a
+map may emit far more than the limit. A combiner, a reduce function, is
+applied to the values of each key as a run is spilled and again as the runs
+are merged, shrinking what the reducers fetch. Runs and the output file hold
+marshalled records, which carry any key or value a map emits, binary ones
+included, byte for byte.
+"""
+from heapq import merge
+from itertools import groupby
+import json
+import marshal
+import os
+
+# Bytes charged to every buffered record on top of the size of its key and
+# value, for the tuple that holds it and the sort key built for it.
+RECORD_OVERHEAD = 200
+# Most runs merged at once; more are first merged into fewer, larger runs.
+MERGE_FACTOR = 10
+
+class MapOutputBuffer(object):
+    def __init__(self, outputPath, indexPath, numReduces, limit, combiner=None):
+        self.outputPath = outputPath
+        self.indexPath = indexPath
+        self.numReduces = max(1, numReduces)
+        self.limit = limit
+        self.combiner = combiner
+        self.records = []
+        self.used = 0
+        self.runs = []
+        self.spills = 0
+
+    def collect(self, p, key, value):
+        self.records.append((p, key, value))
+        self.used += sizeOf(key) + sizeOf(value) + RECORD_OVERHEAD
+        if self.used >= self.limit:
+            self.spill()
+
+    # Sort the buffer and write it out as the next run.
+    def spill(self):
+        self.records.sort(key=recordKey)
+        self.writeRun(self.records)
+        self.records = []
+        self.used = 0
+
+    def writeRun(self, records):
+        path = "{0}.spill{1}".format(self.outputPath, self.spills)
+        self.spills += 1
+        with open(path, "wb") as run:
+            for p, key, value in self.combine(records):
+                marshal.dump((p, key, value), run)
+        self.runs.append(path)
+
+    # Yield the sorted records, with the values of each key combined.
+    def combine(self, records):
+        if self.combiner == None:
+            for record in records:
+                yield record
+            return
+        for (p, key), group in groupby(records, recordKey):
+            values = [value for p, key, value in group]
+            if len(values) == 1:
+                yield p, key, values[0]
+            else:
+                yield p, key, self.combiner(key, values)
+
+    # Merge the runs, or just sort the buffer if nothing was spilled, into the
+    # output file and write its index.
+    def close(self):
+        if len(self.runs) == 0:
+            self.records.sort(key=recordKey)
+            records = self.records
+        else:
+            if len(self.records) > 0:
+                self.spill()
+            while len(self.runs) > MERGE_FACTOR:
+                runs = self.runs[:MERGE_FACTOR]
+                self.runs = self.runs[MERGE_FACTOR:]
+                self.writeRun(merge(*[readRun(run) for run in runs]))
+                for run in runs:
+                    os.remove(run)
+            records = merge(*[readRun(run) for run in self.runs])
+        index = []
+        offset = 0
+        with open(self.outputPath, "wb") as output:
+            for p, key, value in self.combine(records):
+                while len(index) <= p:
+                    index.append([offset, 0])
+                record = marshal.dumps((key, value))
+                output.write(record)
+                index[p][1] += len(record)
+                offset += len(record)
+        while len(index) < self.numReduces:
+            index.append([offset, 0])
+        with open(self.indexPath, "w") as indexFile:
+            json.dump(index, indexFile)
+        self.discard()
+
+    def discard(self):
+        for run in self.runs:
+            if os.path.exists(run):
+                os.remove(run)
+        self.runs = []
+        self.records = []
+
+# Rough bytes held by a key or value.
+def sizeOf(value):
+    if isinstance(value, basestring):
+        return 40 + len(value)
+    if isinstance(value, (int, long, float)) or value == None:
+        return 8
+    return len(marshal.dumps(value))
+
+def recordKey(record):
+    return record[0], record[1]
+
+# Stream the marshalled records of a run or of a map's output, in order.
+def readRun(path):
+    with open(path, "rb") as run:
+        while True:
+            try:
+                yield marshal.load(run)
+            except EOFError:
+                return
@@ -0,0 +1,75 @@
+import heapq
+import time
+
+class Timer(object):
+    __slots__ = ("deadline", "callback", "arg", "cancelled", "queued")
+
+    def __init__(self, deadline, callback, arg):
+        self.deadline = deadline
+        self.callback = callback
+        self.arg = arg
+        self.cancelled = False
+        self.queued = True
+
+class TimerQueue(object):
+    """Deadlines shared by the modules of one process.
+
+    Timers are kept in a heap ordered by deadline, so expire() only touches
+    the timers that are due. Cancelled timers stay in the heap until they
+    reach its top or until they make up half of it.
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = 0
+        self.cancelled = 0
+
+    # Call callback(arg) once time.time() reaches deadline.
+    def schedule(self, deadline, callback, arg=None):
+        timer = Timer(deadline, callback, arg)
+        self.counter += 1
+        heapq.heappush(self.heap, (deadline, self.counter, timer))
+        return timer
+
+    def cancel(self, timer):
+        if timer == None or timer.cancelled:
+            return
+        timer.cancelled = True
+        if not timer.queued:
+            return
+        self.cancelled += 1
+        if self.cancelled > len(self.heap) / 2:
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def pop(self):
+        timer = heapq.heappop(self.heap)[2]
+        timer.queued = False
+        if timer.cancelled:
+            self.cancelled -= 1
+        return timer
+
+    # Run the callbacks of every timer that is due; returns how many ran.
+    # Timers scheduled by those callbacks run on the next call at the earliest.
+    def expire(self):
+        now = time.time()
+        due = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            due.append(self.pop())
+        fired = 0
+        for timer in due:
+            if not timer.cancelled:
+                timer.callback(timer.arg)
+                fired += 1
+        return fired
+
+    # Seconds until the next timer is due, or None if there are none.
+    def timeout(self):
+        while len(self.heap) > 0 and self.heap[0][2].cancelled:
+            self.pop()
+        if len(self.heap) == 0:
+            return None
+        return max(0, self.heap[0][0] - time.time())
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
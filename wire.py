@@ -0,0 +1,222 @@
+"""Packet format of the session layer.
+
+Every datagram starts with a fixed header:
+
+    version   B   VERSION
+    kind      B   index in KINDS
+    codec     B   code of the codec that encoded the payload
+    IP        4s  sender's IPv4 address
+    PORT      H   sender's port
+    ID        I   sender's session ID
+    epoch     I   sender's incarnation of its session with the receiver
+    echo      I   receiver's incarnation the sender last heard from (0 if
+                  none)
+    rpcId     Q   caller's number for the RPC (0 for pings)
+    seq       I   sender's sequence number of a "msg" or "reply" packet to
+                  this receiver, counted from 1 in each epoch (0 for other
+                  kinds)
+    ack       I   cumulative ack: the sender has received every "msg" and
+                  "reply" packet of the receiver's echo epoch up to this
+                  sequence number
+
+followed by the payload, encoded by one of CODECS; pings and pongs carry
+none, "ack" packets the sequence numbers of any packets received beyond the
+cumulative ack. The header names the codec, so processes using different codecs
+still understand each other. JSON turns tuples into lists and strings into
+unicode; marshal keeps them but only speaks to Python.
+
+A packet that would be longer than DATAGRAM bytes is sent as "frag" packets
+instead, each carrying after the header
+
+    kind      B   kind of the whole packet
+    index     H   number of this fragment
+    count     H   number of fragments
+    length    I   bytes in the whole payload
+
+and the next CHUNK bytes of the payload. The receiver collects them in a
+Reassembly and asks for the ones it is missing with a "nack" packet whose
+payload is [kind, [index, ...]]. A payload is at most MAX_PAYLOAD bytes, and
+a fragment whose count does not match its length is dropped before any
+buffer is allocated for it.
+
+Short packets to the same peer may be sent together as one "batch" packet,
+which after its header holds a record per packet:
+
+    kind      B   kind of the packet
+    codec     B   code of the codec that encoded its payload
+    rpcId     Q   the packet's RPC id
+    seq       I   the packet's sequence number
+    length    H   bytes in its payload
+
+each followed by the payload; the batch's own header carries the epochs and
+the ack.
+"""
+import json
+import marshal
+import socket
+import struct
+
+VERSION = 3
+HEADER = struct.Struct("!BBB4sHIIIQII")
+FRAGMENT = struct.Struct("!BHHI")
+RECORD = struct.Struct("!BBQIH")
+# Largest datagram sent, chosen to fit an Ethernet frame.
+DATAGRAM = 1400
+CHUNK = DATAGRAM - HEADER.size - FRAGMENT.size
+# Largest payload sent, or reassembled from the lengths fragments claim.
+MAX_PAYLOAD = 16 << 20
+KINDS = ("ping", "pong", "msg", "reply", "ack", "frag", "nack", "batch")
+KIND_CODES = dict((kind, code) for code, kind in enumerate(KINDS))
+
+# name -> (code, encode, decode)
+CODECS = {}
+DECODERS = {}
+
+def register(name, code, encode, decode):
+    CODECS[name] = (code, encode, decode)
+    DECODERS[code] = decode
+
+register("json", 0, json.dumps, json.loads)
+register("marshal", 1, marshal.dumps, marshal.loads)
+
+class WireError(Exception):
+    pass
+
+class Encoder(object):
+    """Encodes the packets sent by one sender, whose locator is (IP, PORT,
+    ID), with the named codec."""
+    __slots__ = ("code", "encodePayload", "address", "port", "id")
+
+    def __init__(self, locator, codec="json"):
+        self.code, self.encodePayload, decode = CODECS[codec]
+        self.address = socket.inet_aton(locator[0])
+        self.port = locator[1]
+        self.id = locator[2]
+
+    def header(self, kind, rpcId, seq=0, ack=0, epoch=0, echo=0):
+        return HEADER.pack(VERSION, KIND_CODES[kind], self.code,
+                           self.address, self.port, self.id, epoch, echo,
+                           rpcId, seq, ack)
+
+    def body(self, payload):
+        if payload == None:
+            return ""
+        return self.encodePayload(payload)
+
+    def encode(self, kind, rpcId=0, payload=None, seq=0, ack=0, epoch=0,
+               echo=0):
+        return self.header(kind, rpcId, seq, ack, epoch, echo) + self.body(payload)
+
+    # The fragment with the given index of a body too long for one datagram.
+    def fragment(self, kind, rpcId, body, index, seq=0, ack=0, epoch=0,
+                 echo=0):
+        start = index * CHUNK
+        return (self.header("frag", rpcId, seq, ack, epoch, echo) +
+                FRAGMENT.pack(KIND_CODES[kind], index, fragments(body),
+                              len(body)) +
+                body[start:start + CHUNK])
+
+    # One packet holding every (kind, rpcId, seq, body) of records.
+    def batch(self, records, ack=0, epoch=0, echo=0):
+        parts = [self.header("batch", 0, 0, ack, epoch, echo)]
+        for kind, rpcId, seq, body in records:
+            parts.append(RECORD.pack(KIND_CODES[kind], self.code, rpcId, seq,
+                                     len(body)))
+            parts.append(body)
+        return "".join(parts)
+
+def fragments(body):
+    if len(body) > MAX_PAYLOAD:
+        raise WireError("payload too long")
+    return (len(body) + CHUNK - 1) / CHUNK
+
+# Fragment headers come off the network; check that count and length agree
+# before a buffer of length bytes is allocated.
+def checkFragments(count, length):
+    if length > MAX_PAYLOAD or count != (length + CHUNK - 1) / CHUNK:
+        raise WireError("bad fragment count")
+
+# Returns (locator, kind, codec code, rpcId, seq, ack, epoch, echo) of a
+# packet.
+def decodeHeader(packet):
+    if len(packet) < HEADER.size:
+        raise WireError("short packet")
+    (version, kind, code, address, port, ID, epoch, echo, rpcId, seq,
+     ack) = HEADER.unpack_from(packet)
+    if version != VERSION or kind >= len(KINDS) or code not in DECODERS:
+        raise WireError("unknown packet")
+    return ((socket.inet_ntoa(address), port, ID), KINDS[kind], code, rpcId,
+            seq, ack, epoch, echo)
+
+def decodePayload(code, data):
+    if len(data) == 0:
+        return None
+    return DECODERS[code](data)
+
+# Returns (locator, kind, rpcId, payload) of a packet that is not a fragment.
+def decode(packet):
+    locator, kind, code, rpcId, seq, ack, epoch, echo = decodeHeader(packet)
+    return locator, kind, rpcId, decodePayload(code, packet[HEADER.size:])
+
+# Returns (kind, index, count, length, data) of a "frag" packet.
+def decodeFragment(packet):
+    if len(packet) < HEADER.size + FRAGMENT.size:
+        raise WireError("short fragment")
+    kind, index, count, length = FRAGMENT.unpack_from(packet, HEADER.size)
+    if kind >= len(KINDS) or index >= count:
+        raise WireError("bad fragment")
+    checkFragments(count, length)
+    return KINDS[kind], index, count, length, packet[HEADER.size + FRAGMENT.size:]
+
+# Yield (kind, codec code, rpcId, seq, payload data) of every record of a
+# "batch" packet.
+def decodeBatch(packet):
+    offset = HEADER.size
+    while offset < len(packet):
+        if offset + RECORD.size > len(packet):
+            raise WireError("short record")
+        kind, code, rpcId, seq, length = RECORD.unpack_from(packet, offset)
+        offset += RECORD.size
+        if kind >= len(KINDS) or code not in DECODERS or offset + length > len(packet):
+            raise WireError("bad record")
+        yield KINDS[kind], code, rpcId, seq, packet[offset:offset + length]
+        offset += length
+
+class Reassembly(object):
+    """The fragments of one payload received so far, copied into a buffer
+    allocated once for the whole payload."""
+    __slots__ = ("code", "data", "received", "missing", "time", "timer")
+
+    def __init__(self, code, count, length):
+        checkFragments(count, length)
+        self.code = code
+        self.data = bytearray(length)
+        self.received = bytearray(count)
+        self.missing = count
+        self.time = 0
+        self.timer = None
+
+    def add(self, index, data):
+        if index >= len(self.received) or self.received[index]:
+            return
+        start = index * CHUNK
+        if len(data) != min(CHUNK, len(self.data) - start):
+            raise WireError("bad fragment length")
+        self.data[start:start + len(data)] = data
+        self.received[index] = 1
+        self.missing -= 1
+
+    def complete(self):
+        return self.missing == 0
+
+    # Indices of up to limit missing fragments.
+    def missingIndices(self, limit):
+        indices = []
+        index = self.received.find("\0")
+        while index >= 0 and len(indices) < limit:
+            indices.append(index)
+            index = self.received.find("\0", index + 1)
+        return indices
+
+    def payload(self):
+        return decodePayload(self.code, str(self.data))
@@ -3,64 +3,276 @@
 """MapReduce Worker (Container).
 
 Usage:
-    worker.py [-br] [(-d <dr> -t <ttl>)] <IP> <PORT> <MASTER_IP> <MASTER_PORT>
+    worker.py [-br] [-s <slots>] [-o <dir>] [-M <mb>] [--codec=<name>] [(-d <dr> -t <ttl>)] <IP> <PORT> <MASTER_IP> <MASTER_PORT>
 
 Options:
   -h --help                 Show this screen.
   -b --background           Run service in background.
   -r --random               Randomize completion time.
+  -s --slots=<slots>        Number of attempts run at once [default: 1].
+  -o --output=<dir>         Directory for task output [default: /tmp/mappy].
+  -M --memory=<mb>          MB of map output buffered before spilling to disk,
+                            shared by the slots [default: 100].
+  --codec=<name>            Payload codec of sent packets (see wire.py) [default: json].
   -d --die=<dr>             Probability that the worker will die [default: 0.0].
   -t --timeToLive=<ttl>     Average time worker lives before death in tasks.
 """
 from docopt import docopt
 from rpc import RPCManager, RPC
-from session import WorkerSessionManager
+from session import WorkerSessionManager, earliest
+from loop import EventLoop
+from functions import (indexPath, isMapWork, isRealWork, isReduceWork,
+                       runMap, runReduce)
+from shuffle import ShuffleServer, fetch, mapOutputPath
+import json
 import time
 import daemon
-from multiprocessing import Queue
+from collections import deque
+from multiprocessing import Pipe, Pool
+import glob
+from multiprocessing.pool import ThreadPool
 from random import gauss, random
+import os
+import shutil
 import sys
+import threading
 
 RAND = 0
+SLOTS = 1
+OUTPUT = "/tmp/mappy"
+# Bytes of map output each slot may buffer.
+SPILL_LIMIT = 100 << 20
+# Seconds between a reducer's polls of the master for completed maps.
+SHUFFLE_POLL = 1.0
+# Map outputs fetched at once by the reducers of this worker.
+FETCHERS = 5
 DIE = False
 TTL = 0
+CODEC = "json"
+# Descriptors of the worker's ports, closed by process pools forked once they
+# are open so that a leftover pool process cannot hold them.
+INHERITED = []
 
+def closeInherited(fds):
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+# A slot's own process pool, so that killing the slot's work can terminate it.
+def slotPool():
+    return Pool(1, closeInherited, (list(INHERITED),))
+
+class Slot(object):
+    """One container of this worker, running at most one attempt.
+
+    Real work runs in the slot's own process and writes to a temporary file
+    that COMMIT renames to its final name; other work is simulated. Work that
+    is discarded while it runs is terminated with its process.
+    A reduce first polls the master for completed maps and, if it is real,
+    fetches its partition of each of them as they complete.
+    """
+    def __init__(self, index, pool):
+        self.index = index
+        self.pool = pool
+        self.state = "IDLE"
+        self.working = None
+        self.doneTime = 0
+        self.result = None
+        self.output = None
+        self.final = None
+        self.launches = 0
+        self.shuffleDir = None
+        self.resetShuffle()
+
+    def resetShuffle(self):
+        # map work (as JSON) -> container holding its output
+        self.mapOutputs = {}
+        # map work (as JSON) -> fetched segment, or the fetch's AsyncResult
+        self.fetched = {}
+        self.fetching = {}
+        # maps whose last fetch failed; retried after the next poll
+        self.fetchFailed = set()
+        self.eventIndex = 0
+        self.eventsRPC = None
+        self.pollTime = 0
+
+    def work(self):
+        rpcType, (work, index) = self.working.msg
+        return work
+
+    def start(self, wake):
+        self.launches += 1
+        work = self.work()
+        if isMapWork(work):
+            self.final = mapOutputPath(OUTPUT, work[0])
+            self.output = "{0}.{1}.{2}.tmp".format(self.final, self.index,
+                                                   self.launches)
+            self.result = self.pool.apply_async(runMap, (work, self.output, SPILL_LIMIT),
+                                                callback=wake)
+        else:
+            self.final = os.path.join(OUTPUT, "reduce-{0}.out".format(work[1]))
+            self.output = "{0}.{1}.{2}.tmp".format(self.final, self.index,
+                                                   self.launches)
+            self.result = self.pool.apply_async(runReduce, (work, self.fetched.values(), self.output),
+                                                callback=wake)
+
+    def commit(self):
+        os.rename(self.output, self.final)
+        if os.path.exists(indexPath(self.output)):
+            os.rename(indexPath(self.output), indexPath(self.final))
+        self.output = None
+        self.discardShuffle()
+
+    # Poll the master for completed maps until every map of this reduce is
+    # known, and fetched if the reduce is real; returns True once they are.
+    def shuffle(self, rpcManager, fetchers, wake):
+        rpc = self.eventsRPC
+        if rpc != None and rpc.status in ("complete", "failed"):
+            if rpc.status == "complete":
+                for work, container in rpc.reply:
+                    self.mapOutputs[json.dumps(work)] = container
+                self.eventIndex += len(rpc.reply)
+                if len(rpc.reply) > 0:
+                    # the master may have more; ask again at once
+                    self.pollTime = 0
+            self.eventsRPC = None
+            self.fetchFailed.clear()
+        work = self.work()
+        if isRealWork(work):
+            self.fetch(fetchers, wake)
+            done = len(self.fetched) >= work[2]
+        else:
+            done = len(self.mapOutputs) >= work[2]
+        if done:
+            self.pollTime = 0
+            return True
+        if self.eventsRPC == None and time.time() >= self.pollTime:
+            self.eventsRPC = RPC(self.working.locator, None,
+                                 ("MAP_EVENTS", self.eventIndex))
+            rpcManager.send(self.eventsRPC)
+            self.pollTime = time.time() + SHUFFLE_POLL
+        return False
+
+    # Collect finished fetches and start fetching every other known map.
+    def fetch(self, fetchers, wake):
+        for key, result in self.fetching.items():
+            if result.ready():
+                del self.fetching[key]
+                if result.get() == "failed":
+                    self.fetchFailed.add(key)
+                else:
+                    self.fetched[key] = self.segmentPath(key)
+        if self.shuffleDir == None:
+            self.launches += 1
+            self.shuffleDir = os.path.join(OUTPUT, "shuffle-{0}.{1}.{2}".format(
+                self.work()[1], self.index, self.launches))
+            os.makedirs(self.shuffleDir)
+        for key, container in self.mapOutputs.items():
+            if (key in self.fetched or key in self.fetching or
+                    key in self.fetchFailed):
+                continue
+            self.fetching[key] = fetchers.apply_async(
+                fetch, (container[0], json.loads(key)[0], self.work()[1],
+                        self.segmentPath(key)), callback=wake)
+
+    def segmentPath(self, key):
+        return os.path.join(self.shuffleDir, "map-{0}".format(json.loads(key)[0]))
+
+    # Forget any work this slot ran. A map or reduce still running is killed
+    # with the slot's process, which a fresh one replaces, and every file it
+    # wrote (output, index, spilled and merged runs) is removed.
+    def discard(self):
+        if self.result != None and not self.result.ready():
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = slotPool()
+        self.result = None
+        if self.output != None:
+            for path in glob.glob(self.output + "*"):
+                os.remove(path)
+        self.output = None
+        self.discardShuffle()
+
+    def discardShuffle(self):
+        if self.shuffleDir != None:
+            shutil.rmtree(self.shuffleDir, ignore_errors=True)
+        self.shuffleDir = None
+
+# The slot named by a [work, slot] RPC payload, or None.
+def payloadSlot(slots, payload):
+    if not isinstance(payload, (list, tuple)) or len(payload) != 2:
+        return None
+    work, index = payload
+    if not isinstance(index, int) or index < 0 or index >= len(slots):
+        return None
+    return slots[index]
 
 def run(IP, PORT, mIP, mPORT):
-    processQ = Queue()
-    sessionManager = WorkerSessionManager(IP, PORT, mIP, mPORT, processQ)
+    # Fork the slots' processes before any sockets are opened.
+    slots = [Slot(i, slotPool()) for i in range(SLOTS)]
+    if not os.path.isdir(OUTPUT):
+        os.makedirs(OUTPUT)
+    fetchers = ThreadPool(FETCHERS)
+    shuffleServer = ShuffleServer(IP, PORT, OUTPUT)
+    shuffleServer.start()
+    # Finished maps, reduces and fetches write to wakeWriter so that the
+    # event loop's select returns without waiting for its next timer. Their
+    # callbacks run on two pools' threads, hence the lock.
+    wakeReader, wakeWriter = Pipe(duplex=False)
+    wakeLock = threading.Lock()
+    def wake(result):
+        with wakeLock:
+            wakeWriter.send(None)
+    processQ = deque()
+    sessionManager = WorkerSessionManager(IP, PORT, mIP, mPORT, processQ,
+                                          codec=CODEC)
     rpcManager = RPCManager(sessionManager, processQ)
-    working = None
-    state = "IDLE";
-    doneTime = 0
-    while True:
-        sessionManager.poll()
-        rpcManager.poll()
+    INHERITED.extend([sessionManager.receiver.fileno(),
+                      sessionManager.sender.sock.fileno(),
+                      shuffleServer.fileno()])
+
+    # Advertise the slots to the master once its session opens.
+    def register(locator):
+        rpcManager.send(RPC(locator, None, ("REGISTER", SLOTS)))
+    sessionManager.openHandlers.append(register)
+
+    # Runs the slots; their rules poll the RPCs, the process pools and the
+    # clock, so on every pass.
+    def runSlots():
+        while wakeReader.poll():
+            wakeReader.recv()
         
         # Convert incoming RPCs (events) into state changes
         for rpc in rpcManager.inRPC.values():
             if rpc.status == "pending":
                 rpcType, payload = rpc.msg
+                slot = payloadSlot(slots, payload)
                 if rpcType == "LAUNCH":
-                    if state == "IDLE":
-                        state = "RUNNING"
-                        working = rpc
+                    if slot != None and slot.state == "IDLE":
+                        slot.resetShuffle()
+                        slot.state = "RUNNING"
+                        slot.working = rpc
                         rpc.status = "working"
                         continue
                 elif rpcType == "COMMIT":
-                    if state == "COMPLETE":
-                        state = "COMMITTING"
-                        working = rpc
+                    if slot != None and slot.state == "COMPLETE":
+                        slot.state = "COMMITTING"
+                        slot.working = rpc
                         rpc.status = "working"
                         continue
                 elif rpcType == "CONTAINER_REMOTE_CLEANUP":
-                    state = "CLEANUP"
-                    if working != None:
-                        working.reply = "failed"
-                        working.status = "send"
-                    working = rpc
-                    rpc.status = "working"
-                    continue
+                    if slot != None:
+                        slot.resetShuffle()
+                        slot.state = "CLEANUP"
+                        if slot.working != None:
+                            slot.working.reply = "failed"
+                            slot.working.status = "send"
+                        slot.doneTime = 0
+                        slot.working = rpc
+                        rpc.status = "working"
+                        continue
                 elif rpcType == "DIE":
                     sys.exit(0)
                 
@@ -68,54 +280,101 @@ def run(IP, PORT, mIP, mPORT):
                 rpc.status = "send"
                     
         # Rules engine
-        if state == "IDLE":
-            pass
-        elif state == "RUNNING":
-            # simulate random completion time
-            if doneTime == 0:
-                doneTime = time.time() + 5.0 + RAND * gauss(0.0, 1.0)
-            if time.time() > doneTime:
-                working.reply = working.msg
-                working.status = "send"
-                print "Work Finished: ", working.msg, working.locator
-                working = None
-                doneTime = 0
-                state = "COMPLETE"
-        elif state == "COMPLETE":
-            pass
-        elif state == "COMMITTING":
-            # simulate random commit time
-            if doneTime == 0:
-                doneTime = time.time() + 2.0 + RAND * gauss(0.0, 1.0)
-            if time.time() > doneTime:
-                print "Work Committed: ", working.msg, working.locator
-                doneTime = 0
-                state = "CLEANUP"
-        elif state == "CLEANUP":
-            # simulate random cleaup time
-            if doneTime == 0:
-                doneTime = time.time() + 1.0 + RAND * gauss(0.0, 1.0)
-            if time.time() > doneTime:
-                working.reply = working.msg
-                working.status = "send"
-                print "Container Clean: ", working.msg, working.locator
-                working = None
-                doneTime = 0
-                state = "IDLE"
-
-        # Kill failed RPCs
-        for key in rpcManager.outRPC.keys():
-            if rpcManager.outRPC[key].status == "failed":
-                del rpcManager.outRPC[key]
-        
+        for slot in slots:
+            if slot.state == "IDLE":
+                pass
+            elif (slot.state == "RUNNING" and isReduceWork(slot.work()) and
+                    not slot.shuffle(rpcManager, fetchers, wake)):
+                # still waiting for map output
+                pass
+            elif slot.state == "RUNNING" and isRealWork(slot.work()):
+                # run the map or reduce in the slot's process
+                if slot.result == None:
+                    slot.start(wake)
+                elif slot.result.ready():
+                    reply = slot.result.get()
+                    slot.result = None
+                    slot.working.reply = reply
+                    slot.working.status = "send"
+                    print "Work Finished: ", slot.working.msg, slot.working.locator, reply
+                    slot.working = None
+                    if reply == "failed":
+                        slot.discard()
+                        slot.state = "IDLE"
+                    else:
+                        slot.state = "COMPLETE"
+            elif slot.state == "RUNNING":
+                # simulate random completion time
+                if slot.doneTime == 0:
+                    slot.doneTime = time.time() + 5.0 + RAND * gauss(0.0, 1.0)
+                if time.time() > slot.doneTime:
+                    slot.working.reply = slot.working.msg
+                    slot.working.status = "send"
+                    print "Work Finished: ", slot.working.msg, slot.working.locator
+                    slot.working = None
+                    slot.doneTime = 0
+                    slot.state = "COMPLETE"
+            elif slot.state == "COMPLETE":
+                pass
+            elif slot.state == "COMMITTING" and isRealWork(slot.work()):
+                slot.commit()
+                print "Work Committed: ", slot.working.msg, slot.working.locator
+                slot.doneTime = time.time()
+                slot.state = "CLEANUP"
+            elif slot.state == "COMMITTING":
+                # simulate random commit time
+                if slot.doneTime == 0:
+                    slot.doneTime = time.time() + 2.0 + RAND * gauss(0.0, 1.0)
+                if time.time() > slot.doneTime:
+                    print "Work Committed: ", slot.working.msg, slot.working.locator
+                    slot.doneTime = 0
+                    slot.state = "CLEANUP"
+            elif slot.state == "CLEANUP":
+                # simulate random cleaup time; real output is removed at once
+                if slot.doneTime == 0 and isRealWork(slot.work()):
+                    slot.discard()
+                    slot.doneTime = time.time()
+                elif slot.doneTime == 0:
+                    slot.doneTime = time.time() + 1.0 + RAND * gauss(0.0, 1.0)
+                if time.time() > slot.doneTime:
+                    slot.working.reply = slot.working.msg
+                    slot.working.status = "send"
+                    print "Container Clean: ", slot.working.msg, slot.working.locator
+                    slot.working = None
+                    slot.doneTime = 0
+                    slot.state = "IDLE"
+
         if DIE and time.time() > TTL:
             sys.exit(0)
+
+    # Seconds until a slot's simulated work ends, it next asks for map
+    # events or the worker is due to die.
+    def slotsTimeout():
+        timeouts = []
+        for slot in slots:
+            if slot.doneTime != 0:
+                timeouts.append(max(0, slot.doneTime - time.time()))
+            if slot.pollTime != 0 and slot.eventsRPC == None:
+                timeouts.append(max(0, slot.pollTime - time.time()))
+        if DIE:
+            timeouts.append(max(0, TTL - time.time()))
+        return earliest(timeouts)
+
+    # Sleep until a packet arrives, a pool finishes or the next timer is due.
+    loop = EventLoop(sessionManager, [wakeReader])
+    loop.add(rpcManager.poll, rpcManager.timeout)
+    loop.add(runSlots, slotsTimeout, everyPass=True)
+    loop.run()
     
 
 if __name__ == '__main__':
     args = docopt(__doc__)
     print(args)
     RAND = int(args['--random'])
+    SLOTS = int(args['--slots'])
+    OUTPUT = os.path.join(args['--output'], str(args['<PORT>']))
+    CODEC = args['--codec']
+    SPILL_LIMIT = int(float(args['--memory']) * (1 << 20)) / SLOTS
     if random() < float(args['--die']):
         DIE = True
         TTL = time.time() + 5.0 * gauss(float(args['--timeToLive']),